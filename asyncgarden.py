@@ -0,0 +1,642 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden asynchronous API
+
+Non blocking version of the OpenGarden API, many devices can be driven
+by a single event loop without threads.
+
+Every method of AsyncOpenGarden returns a Future, coroutines are plain
+generators which yield the futures to wait for and are run by the Loop.
+
+Example:
+
+def status(og, device):
+    yield og.connect(device)
+    temp = yield og.temperature()
+    alarm = yield og.get_alarm()
+    print og.serial, temp, alarm
+    og.disconnect()
+
+loop = Loop()
+jobs = [status(AsyncOpenGarden(loop), i) for i in devices]
+loop.run_until_complete(loop.gather(jobs))
+
+To test it without the device use a virtual serial port, see README.
+"""
+
+import os
+import errno
+import select
+import heapq
+import time
+import collections
+import serial
+from opengarden import OpenGarden, ComError, Timeout
+
+class Future:
+    """ The result of an operation not yet completed.
+    """
+
+    def __init__(self):
+        self.done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def result(self):
+        """ Return the result or raise the exception of the operation.
+        """
+
+        if not self.done:
+            raise NameError('NotDone')
+
+        if self._exception is not None:
+            raise self._exception
+
+        return(self._result)
+
+    def exception(self):
+        return(self._exception)
+
+    def add_done_callback(self, fn):
+        if self.done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._complete()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._complete()
+
+    def _complete(self):
+        self.done = True
+
+        for fn in self._callbacks:
+            fn(self)
+
+        self._callbacks = []
+
+class Task(Future):
+    """ Run a generator based coroutine.
+
+    The coroutine yields Futures (or generators, which are spawned as
+    a new Task) and gets back their result or exception.
+    """
+
+    def __init__(self, loop, coro):
+        Future.__init__(self)
+        self._loop = loop
+        self._coro = coro
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, exception):
+        try:
+            if exception is None:
+                f = self._coro.send(value)
+            else:
+                f = self._coro.throw(exception)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception as e:
+            self.set_exception(e)
+            return
+
+        if not isinstance(f, Future):
+            f = self._loop.spawn(f)
+
+        f.add_done_callback(self._wakeup)
+
+    def _wakeup(self, f):
+        self._loop.call_soon(self._step, f._result, f._exception)
+
+class Loop:
+    """ select() based event loop.
+    """
+
+    def __init__(self):
+        self._ready = collections.deque()
+        self._timers = []
+        self._readers = {}
+        self._writers = {}
+
+    def call_soon(self, fn, *args):
+        self._ready.append((fn, args))
+
+    def call_later(self, delay, fn, *args):
+        """ Call fn(*args) after delay seconds.
+
+        Return:
+            a handle which can be given to cancel().
+        """
+
+        handle = [time.time() + delay, fn, args]
+        heapq.heappush(self._timers, handle)
+        return(handle)
+
+    def cancel(self, handle):
+        handle[1] = None
+
+    def add_reader(self, fd, fn):
+        self._readers[fd] = fn
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def add_writer(self, fd, fn):
+        self._writers[fd] = fn
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+
+    def spawn(self, coro):
+        """ Start a coroutine and return its Task.
+        """
+
+        return(Task(self, coro))
+
+    def gather(self, fs):
+        """ Wait for a list of futures or coroutines.
+
+        Return:
+            a future for the list of the results, if any of them fails
+            the first exception is raised once all are done.
+        """
+
+        fs = [i if isinstance(i, Future) else self.spawn(i) for i in fs]
+        gathered = Future()
+        left = [len(fs)]
+
+        def _done(f):
+            left[0] -= 1
+
+            if left[0]:
+                return
+
+            for i in fs:
+                if i.exception() is not None:
+                    gathered.set_exception(i.exception())
+                    return
+
+            gathered.set_result([i.result() for i in fs])
+
+        if not fs:
+            gathered.set_result([])
+
+        for i in fs:
+            i.add_done_callback(_done)
+
+        return(gathered)
+
+    def run_until_complete(self, f):
+        """ Run the loop until the future (or coroutine) f is done.
+
+        Return:
+            the result of f.
+        """
+
+        if not isinstance(f, Future):
+            f = self.spawn(f)
+
+        while not f.done:
+            self._run_once()
+
+        return(f.result())
+
+    def _run_once(self):
+        timeout = None
+
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+
+        if self._readers or self._writers:
+            r, w, x = select.select(self._readers.keys(),
+                    self._writers.keys(), [], timeout)
+        else:
+            r, w = [], []
+
+            if timeout:
+                time.sleep(timeout)
+
+        for fd in r:
+            if fd in self._readers:
+                self._readers[fd]()
+
+        for fd in w:
+            if fd in self._writers:
+                self._writers[fd]()
+
+        now = time.time()
+
+        while self._timers and self._timers[0][0] <= now:
+            when, fn, args = heapq.heappop(self._timers)
+
+            if fn is not None:
+                self._ready.append((fn, args))
+
+        for i in range(len(self._ready)):
+            fn, args = self._ready.popleft()
+            fn(*args)
+
+class _NeedMore(Exception):
+    """ The reply is not yet completely received. """
+    pass
+
+class _LineBuffer:
+    """ Stands for the serial port when the _read_* methods of OpenGarden
+    parse a reply, serving the lines already received.
+    """
+
+    def __init__(self):
+        self.data = ''
+        self.pos = 0
+
+    def readline(self):
+        end = self.data.find('\n', self.pos)
+
+        if end == -1:
+            raise _NeedMore()
+
+        line = self.data[self.pos:end + 1]
+        self.pos = end + 1
+        return(line)
+
+    def read(self, size=1):
+        if len(self.data) - self.pos < size:
+            raise _NeedMore()
+
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return(chunk)
+
+    def consume(self):
+        self.data = self.data[self.pos:]
+        self.pos = 0
+
+class _Batch:
+    """ Stands for opengarden.Batch, queueing each command on the device.
+    """
+
+    def __init__(self, og):
+        self._og = og
+        self.cmds = []
+        self.futures = []
+
+    def add(self, cmd, reply=None):
+        self.cmds.append(cmd)
+        self.futures.append(self._og._command(cmd, reply))
+
+    def results(self):
+        """ Return the (cmd, value, error) of the commands done.
+        """
+
+        return([(cmd, f._result, f.exception()) \
+                for cmd, f in zip(self.cmds, self.futures) if f.done])
+
+class AsyncOpenGarden(OpenGarden):
+    """ Non blocking OpenGarden device.
+
+    It has the same methods of OpenGarden, but each of them returns
+    a Future instead of waiting for the device. Commands issued
+    without waiting are pipelined on the serial line.
+
+    The attributes (version, serial, sunsite, ...) are updated as
+    the replies arrive.
+    """
+
+    def __init__(self, loop):
+        OpenGarden.__init__(self)
+        self.loop = loop
+        self._port = None
+        self._fd = None
+        self._out = ''
+        self._s = _LineBuffer()
+        self._pending = collections.deque()
+        self._timer = None
+
+    def _command(self, cmd, reply=None):
+        """ Queue a command to the device.
+
+        Keyword arguments:
+            cmd -- the command string to send.
+            reply -- the OpenGarden._read_* method which parses the reply,
+                by default an OK is expected.
+
+        Return:
+            a Future for the value returned by reply.
+        """
+
+        f = Future()
+
+        if self._fd is None:
+            f.set_exception(NameError('NoConnect'))
+            return(f)
+
+        if reply is None:
+            reply = self._get_ok
+
+        self._pending.append([cmd, reply, f, False, time.time()])
+
+        if len(self._pending) == 1:
+            self._arm_timer()
+
+        self._out += cmd + '\r'
+        self.loop.add_writer(self._fd, self._on_write)
+        return(f)
+
+    def _on_write(self):
+        try:
+            n = os.write(self._fd, self._out)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                self._fail(e)
+
+            return
+
+        self._out = self._out[n:]
+
+        if not self._out:
+            self.loop.remove_writer(self._fd)
+
+    def _on_read(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                self._fail(e)
+
+            return
+
+        if not data:
+            # end of file, the device is gone: fail the pending commands
+            # and the ones to come with NoConnect.
+            self.disconnect()
+            return
+
+        self._s.data += data
+        self._parse()
+
+    def _parse(self):
+        """ Match the data received against the pending commands.
+        """
+
+        while self._pending:
+            cmd, reply, f, echoed, start = self._pending[0]
+            self._s.pos = 0
+
+            try:
+                if not echoed:
+                    echo = self._s.read(len(cmd) + 2)[:len(cmd)]
+
+                    if echo != cmd:
+                        self._echo_error(cmd, echo)
+
+                    self._s.consume()
+                    self._pending[0][3] = True
+                    self._arm_timer()
+
+                value = reply()
+            except _NeedMore:
+                return
+            except ComError as e:
+                self._fail(e)
+                return
+            except Exception as e:
+                self._s.consume()
+                self._pending.popleft()
+                f.set_exception(e)
+            else:
+                self._s.consume()
+                self._pending.popleft()
+                self.latency.add(time.time() - start)
+                f.set_result(value)
+
+            self._arm_timer()
+
+    def _readline(self):
+        return(self._s.readline())
+
+    def _arm_timer(self):
+        """ Give the first pending command echo_timeout to be echoed and
+        timeout to be answered.
+        """
+
+        if self._timer is not None:
+            self.loop.cancel(self._timer)
+            self._timer = None
+
+        if self._pending:
+            if self._pending[0][3]:
+                delay = self.timeout
+            else:
+                delay = min(self.timeout, self.echo_timeout)
+
+            self._timer = self.loop.call_later(delay, self._timed_out)
+
+    def _timed_out(self):
+        cmd, reply, f, echoed, start = self._pending[0]
+        self.latency.add_timeout()
+
+        if echoed:
+            self._fail(Timeout(cmd, "reply"))
+        else:
+            self._fail(Timeout(cmd, "echo"))
+
+    def _fail(self, exception):
+        """ Fail all the pending commands, the line is out of sync.
+        """
+
+        self._timer = None
+        pending = self._pending
+        self._pending = collections.deque()
+        self._s = _LineBuffer()
+        self._out = ''
+
+        if self._fd is not None:
+            self.loop.remove_writer(self._fd)
+
+        for cmd, reply, f, echoed, start in pending:
+            f.set_exception(exception)
+
+    def connect(self, device):
+        """ Connect to the device and set the device version and serial.
+        """
+
+        if device is None:
+            raise NameError("A device MUST be given!")
+
+        self._device_programs = None
+        self.invalidate()
+        self._port = serial.Serial(device, 9600, timeout=0)
+        self._fd = self._port.fileno()
+        self._port.flushInput()
+        self.loop.add_reader(self._fd, self._on_read)
+        return(self.loop.gather([self._command("L0"),
+                self._command("v", self._read_version),
+                self._command("S", self._read_serial),
+                self._command("y", self._read_sunsite)]))
+
+    def disconnect(self):
+        """ Close the connection.
+        """
+
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            self._fail(NameError('NoConnect'))
+            self._fd = None
+            self._port.close()
+
+        f = Future()
+        f.set_result(None)
+        return(f)
+
+    def _version(self):
+        return(self._command("v", self._read_version))
+
+    def _serial(self):
+        return(self._command("S", self._read_serial))
+
+    def _log_disable(self):
+        return(self._command("L0"))
+
+    def rt_load_sunsite(self):
+        return(self._command("y", self._read_sunsite))
+
+    def rt_save_sunsite(self, sunsite=None):
+        if sunsite:
+            self.sunsite = sunsite
+
+        return(self._command(self._cmd_sunsite(),
+                self._reply_saved("sunsite", self.sunsite)))
+
+    def rt_load_valve(self):
+        return(self._command("V", self._read_valve))
+
+    def rt_save_valve(self, valve=None):
+        if valve:
+            self.valve = valve
+
+        return(self._command(self._cmd_valve(),
+                self._reply_saved("valve", self.valve)))
+
+    def rt_load_alarm_level(self):
+        return(self._command("a", self._read_alarm_level))
+
+    def rt_save_alarm_level(self, alarm=None):
+        if alarm:
+            self.alarm = alarm
+
+        return(self._command(self._cmd_alarm_level(),
+                self._reply_saved("alarm", self.alarm)))
+
+    def rt_load_led_setup(self):
+        return(self._command("e", self._read_led_setup))
+
+    def rt_save_led_setup(self, led=None):
+        if led:
+            self.led = led
+
+        return(self._command(self._cmd_led_setup(),
+                self._reply_saved("led", self.led)))
+
+    def _send_eepromload_cmd(self):
+        self._device_programs = None
+        return(self._command("r"))
+
+    def _send_eepromsave_cmd(self):
+        return(self._command("s"))
+
+    def _load_programs(self):
+        return(self._command("l", self._read_programs))
+
+    def _save_programs(self, full=False):
+        b = _Batch(self)
+
+        try:
+            self._queue_programs(b, full)
+        except ValueError as e:
+            return(self._failed(e))
+
+        return(self._gather(b))
+
+    def _failed(self, exception):
+        f = Future()
+        f.set_exception(exception)
+        return(f)
+
+    def _gather(self, b):
+        """ Return a future for all the commands of b, when they are
+        done the programs stored are checked like OpenGarden does.
+        """
+
+        f = self.loop.gather(b.futures)
+        f.add_done_callback(lambda f: self._check_programs(b.results()))
+        return(f)
+
+    def time(self, t=None):
+        if t is None:
+            cmd = "d"
+        else:
+            cmd = "d" + str(t)
+
+        return(self._command(cmd, self._read_time))
+
+    def load(self):
+        return(self.loop.gather([self.rt_load_sunsite(),
+                self.rt_load_valve(),
+                self._load_programs(),
+                self.rt_load_alarm_level(),
+                self.rt_load_led_setup()]))
+
+    def save(self):
+        """ Send the attributes changed, like OpenGarden.save().
+        """
+
+        # the commands are sent as they are queued, check first.
+        if self._value("programs") is not None:
+            try:
+                self._check_capacity()
+            except ValueError as e:
+                return(self._failed(e))
+
+        b = _Batch(self)
+        self._queue_saved(b, "led", self._cmd_led_setup)
+        self._queue_saved(b, "alarm", self._cmd_alarm_level)
+
+        if self._value("programs") is not None:
+            self._queue_programs(b)
+
+        self._queue_saved(b, "valve", self._cmd_valve)
+        self._queue_saved(b, "sunsite", self._cmd_sunsite)
+        return(self._gather(b))
+
+    def temperature(self):
+        return(self._command("g", self._read_temperature))
+
+    def get_alarm(self):
+        return(self._command("A", self._read_alarm))
+
+if __name__ == "__main__":
+    print "This is a module"
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
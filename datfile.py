@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" OpenGarden .dat files
+
+The GUI stores the programs and their notes in .dat files. The format
+is binary:
+
+    header  OGDAT\\0, version, programs offset and count, notes offset
+            and length.
+    programs, 6 bytes each: start, length (uint16), days, line (uint8).
+    notes, the text as it is.
+
+so the programs are read without the notes, and the notes are mapped
+in memory only when asked for. The text files of the older GUI
+versions (the programs, one per line, then NOTE_MARKER and the notes)
+are still read.
+
+Example:
+
+write('garden.dat', programs, notes)
+
+dat = DatFile('garden.dat')
+programs = dat.programs()
+notes = dat.notes()
+dat.close()
+"""
+
+import mmap
+import struct
+from program import Program, decodeList
+
+MAGIC = "OGDAT\0"
+VERSION = 1
+HEADER = struct.Struct("<6sHIIII")
+RECORD = struct.Struct("<HHBB")
+NOTE_MARKER = "#Notes begin here\n"
+
+def write(path, programs, notes=''):
+    """ Write the programs and the notes in the binary format.
+    """
+
+    if isinstance(notes, unicode):
+        notes = notes.encode('utf-8')
+
+    block = "".join([RECORD.pack(p.start, p.length, p.days, p.line) \
+            for p in programs])
+    notes_offset = HEADER.size + len(block)
+    f = open(path, "wb")
+
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, HEADER.size, len(programs), \
+                notes_offset, len(notes)))
+        f.write(block)
+        f.write(notes)
+    finally:
+        f.close()
+
+class DatFile:
+    """ A .dat file open for reading, binary or text.
+
+    Raise NameError('BadDatFile') if a binary file is damaged or of a
+    newer version.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        self._map = None
+        head = self._f.read(HEADER.size)
+
+        if head.startswith(MAGIC):
+            self.text = False
+
+            if len(head) < HEADER.size:
+                raise NameError('BadDatFile')
+
+            magic, version, self._programs_offset, self._count, \
+                    self._notes_offset, self._notes_length = \
+                    HEADER.unpack(head)
+
+            if version > VERSION:
+                raise NameError('BadDatFile')
+        else:
+            # the old text format, split it once.
+            self.text = True
+            self._f.seek(0)
+            data = self._f.read()
+            self._f.close()
+            programs, marker, self._notes = data.partition(NOTE_MARKER)
+            self._lines = programs.splitlines()
+
+    def programs(self):
+        """ Read the programs, the notes are not read.
+
+        Return:
+            a list of program.Program.
+        """
+
+        if self.text:
+            return(decodeList(self._lines))
+
+        self._f.seek(self._programs_offset)
+        block = self._f.read(self._count * RECORD.size)
+
+        if len(block) != self._count * RECORD.size:
+            raise NameError('BadDatFile')
+
+        return([Program(*RECORD.unpack_from(block, i * RECORD.size)) \
+                for i in range(self._count)])
+
+    def notes(self):
+        """ Return the notes, the file is mapped in memory the first
+        time they are asked for.
+        """
+
+        if self.text:
+            return(self._notes)
+
+        if not self._notes_length:
+            return('')
+
+        if self._map is None:
+            self._map = mmap.mmap(self._f.fileno(), 0, \
+                    access=mmap.ACCESS_READ)
+
+        end = self._notes_offset + self._notes_length
+
+        if end > len(self._map):
+            raise NameError('BadDatFile')
+
+        return(self._map[self._notes_offset:end])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        if not self._f.closed:
+            self._f.close()
+
+if __name__ == "__main__":
+    print "This is a module"
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden fleet module
+
+Run the same operation on many OpenGarden devices at once, with a
+bounded pool of worker threads.
+
+Example:
+
+fleet = Fleet(read_inventory(open('inventory.txt')), workers=16)
+
+for r in fleet.temperature():
+    if r.error:
+        print r.device, "failed:", r.error
+    else:
+        print r.device, r.serial, r.value, "%.2fs" % r.elapsed
+"""
+
+import time
+import threading
+import Queue
+from opengarden import OpenGarden
+from program import decodeList, MAX_PROGRAMS
+from schedule import upcoming
+from proglib import digest
+
+def read_inventory(f):
+    """ Read the devices from an inventory file.
+
+    One device per line, empty lines and lines starting with # are
+    skipped.
+
+    Return:
+        the list of devices.
+    """
+
+    devices = []
+
+    for line in f:
+        line = line.strip()
+
+        if line and not line.startswith('#'):
+            devices.append(line)
+
+    return(devices)
+
+class Result:
+    """ The outcome of an operation on a single device.
+
+    Attributes:
+        device -- the device (port) name.
+        serial -- the serial number, None if the connection failed.
+        value -- what the operation returned.
+        error -- the exception raised, None on success.
+        elapsed -- seconds spent, connection included.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.serial = None
+        self.value = None
+        self.error = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return "<Result %s %r %r %.3fs>" % (self.device,
+                self.value, self.error, self.elapsed)
+
+class Fleet:
+    """ A set of devices operated in parallel.
+
+    Every operation connects to each device, reads its serial, runs
+    and disconnects, with at most workers devices handled at the same
+    time. The results are returned in the same order of the devices.
+    """
+
+    def __init__(self, devices, workers=8):
+        self.devices = list(devices)
+        self.workers = workers
+
+    def run(self, operation, *args):
+        """ Run operation(og, *args) on every device.
+
+        Keyword arguments:
+            operation -- function called with a connected OpenGarden.
+
+        Return:
+            a list of Result.
+        """
+
+        jobs = Queue.Queue()
+        results = []
+
+        for device in self.devices:
+            result = Result(device)
+            results.append(result)
+            jobs.put(result)
+
+        threads = []
+
+        for i in range(min(self.workers, len(results))):
+            t = threading.Thread(target=self._worker,
+                    args=(jobs, operation, args))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        return(results)
+
+    def _worker(self, jobs, operation, args):
+        while True:
+            try:
+                result = jobs.get_nowait()
+            except Queue.Empty:
+                return
+
+            start = time.time()
+            og = OpenGarden()
+
+            try:
+                og.connect(result.device)
+                # the serial names the device in the results.
+                result.serial = og._serial()
+                result.value = operation(og, *args)
+            except Exception as e:
+                result.error = e
+
+            try:
+                og.disconnect()
+            except Exception:
+                pass
+
+            result.elapsed = time.time() - start
+
+    def get_time(self):
+        """ Read the clock (time_t) of the devices. """
+
+        return(self.run(lambda og: og.time()))
+
+    def set_time(self, t=None):
+        """ Set the clock of the devices, by default to the host time.
+        """
+
+        if t is None:
+            return(self.run(lambda og: og.time(int(time.time()))))
+        else:
+            return(self.run(lambda og: og.time(t)))
+
+    def temperature(self):
+        """ Read [now, media 24h, dfactor] from the devices. """
+
+        return(self.run(lambda og: og.temperature()))
+
+    def alarm(self):
+        """ Read the alarm's lines status (ON/OFF) of the devices. """
+
+        return(self.run(lambda og: og.get_alarm()))
+
+    def get_programs(self):
+        """ Download the programs of the devices. """
+
+        return(self.run(lambda og: og._load_programs()))
+
+    def programs_digest(self):
+        """ Hash the programs of the devices, as proglib.digest(). """
+
+        return(self.run(lambda og: digest(og._load_programs())))
+
+    def send_programs(self, programs):
+        """ Upload the same programs to all the devices.
+
+        More than MAX_PROGRAMS programs raise ValueError before any
+        device is contacted.
+        """
+
+        programs = decodeList(programs)
+
+        if len(programs) > MAX_PROGRAMS:
+            raise ValueError("%d programs, the device stores %d" % \
+                    (len(programs), MAX_PROGRAMS))
+
+        return(self.run(_send_programs, programs))
+
+    def queue(self, limit=10, until=None):
+        """ List the next irrigations (start, end, line) of the devices.
+
+        Keyword arguments:
+            limit -- max number of irrigations of each device.
+            until -- seconds from the device clock to look at.
+        """
+
+        return(self.run(_queue, limit, until))
+
+    def edit_programs(self, edit):
+        """ Change the programs of the devices.
+
+        Keyword arguments:
+            edit -- function which changes in place the
+                programtable.ProgramTable of the programs of a device.
+        """
+
+        return(self.run(_edit_programs, edit))
+
+def _send_programs(og, programs):
+    og.programs = list(programs)
+    og._save_programs()
+    return(og.programs)
+
+def _queue(og, limit, until):
+    now = int(og.time())
+
+    if until is not None:
+        until += now
+
+    return(list(upcoming(og._load_programs(), now, until, limit)))
+
+def _edit_programs(og, edit):
+    # NumPy is needed only here.
+    from programtable import ProgramTable
+
+    table = ProgramTable.from_programs(og._load_programs())
+    edit(table)
+    table.validate(MAX_PROGRAMS)
+    og.programs = table.to_programs()
+    og._save_programs()
+    return(og.programs)
+
+if __name__ == "__main__":
+    print "This is a module"
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" OpenGarden protocol benchmark
+
+Time the OpenGarden API calls against the simulator and measure what
+they cost on the wire: bytes sent and received, round trips (how many
+times the host waits for the device after writing) and wall time.
+
+Example:
+    ./ogarden_bench.py --baudrate 9600 --latency 0 0.02 --output new.json
+    ./ogarden_bench.py --baudrate 9600 --latency 0 0.02 --compare new.json
+"""
+
+import argparse
+import json
+import time
+import opengarden
+from opengarden import OpenGarden
+from simulator import Simulator, LoopbackSerial
+from program import MAX_PROGRAMS
+
+class Meter:
+    """ Serial port wrapper which counts the traffic.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.received = 0
+        self.round_trips = 0
+        self._writing = False
+
+    def write(self, data):
+        self._writing = True
+        self.sent += len(data)
+        return(self.port.write(data))
+
+    def _got(self, data):
+        if self._writing:
+            self.round_trips += 1
+            self._writing = False
+
+        self.received += len(data)
+        return(data)
+
+    def read(self, size=1):
+        return(self._got(self.port.read(size)))
+
+    def readline(self):
+        return(self._got(self.port.readline()))
+
+    def __getattr__(self, name):
+        return(getattr(self.port, name))
+
+    def __setattr__(self, name, value):
+        if name == "timeout":
+            self.port.timeout = value
+        else:
+            self.__dict__[name] = value
+
+def programs(n):
+    """ Return n programs in the device format. """
+
+    return(["%02d,%02d%02d,%03d,ff,%d" % (i, 6 + i / 60, i % 60, 5, i % 8) \
+            for i in range(n)])
+
+def cases(nprograms):
+    """ Return the list of (name, n programs, setup, call) to measure.
+
+    A setup None runs call on an object never connected.
+    """
+
+    def store(n):
+        def setup(og):
+            og.programs = programs(n)
+
+        return(setup)
+
+    def load(n):
+        def setup(og):
+            og.programs = programs(n)
+            og._save_programs()
+
+        return(setup)
+
+    def connect(og):
+        og.connect(og._s)
+
+    nothing = lambda og: None
+    c = [("connect", None, None, connect),
+        ("time", None, nothing, lambda og: og.time()),
+        ("temperature", None, nothing, lambda og: og.temperature()),
+        ("get_alarm", None, nothing, lambda og: og.get_alarm())]
+
+    for n in nprograms:
+        c.append(("load", n, load(n), lambda og: og.load()))
+        c.append(("save", n, store(n), lambda og: og.save()))
+        c.append(("_load_programs", n, load(n), \
+                lambda og: og._load_programs()))
+        c.append(("_save_programs", n, store(n), \
+                lambda og: og._save_programs()))
+
+    return(c)
+
+def measure(name, n, setup, call, baudrate, latency, repeat):
+    """ Run a case repeat times, each on a new simulated device.
+
+    The OpenGarden cache is disabled to measure the wire.
+
+    Return:
+        a dictionary with the counters of a single call and the best
+        wall time.
+    """
+
+    wall = []
+
+    for i in range(repeat):
+        sim = Simulator(baudrate, latency)
+        meter = Meter(LoopbackSerial(sim))
+        og = OpenGarden()
+        og.cache_ttl = 0
+
+        try:
+            if setup is None:
+                og._s = meter
+            else:
+                og.connect(meter)
+                og.load()
+                setup(og)
+
+            meter.reset()
+            commands = sim.commands
+            start = time.time()
+            call(og)
+            wall.append(time.time() - start)
+        finally:
+            # stop the reader thread.
+            og.disconnect()
+
+    return({"method": name, "programs": n, "baudrate": baudrate,
+        "latency": latency, "bytes_sent": meter.sent,
+        "bytes_received": meter.received,
+        "round_trips": meter.round_trips,
+        "commands": sim.commands - commands, "wall": min(wall)})
+
+def key(r):
+    return((r["method"], r["programs"], r["baudrate"], r["latency"]))
+
+def compare(results, old):
+    """ Print the results against an older run.
+    """
+
+    old = dict([(key(r), r) for r in old["results"]])
+    print "%-16s %4s %6s %6s %10s %10s %8s %8s" % ("method", "prog", \
+            "baud", "lat", "wall old", "wall new", "rt old", "rt new")
+
+    for r in results:
+        o = old.get(key(r))
+
+        if o is None:
+            continue
+
+        print "%-16s %4s %6s %6s %10.4f %10.4f %8d %8d%s" % (r["method"], \
+                r["programs"] or "", r["baudrate"] or "", r["latency"], \
+                o["wall"], r["wall"], o["round_trips"], r["round_trips"], \
+                " <<<" if r["wall"] > o["wall"] * 1.2 else "")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='OpenGarden benchmark.')
+    parser.add_argument('--baudrate', type=int, nargs='+', default=[9600], \
+            help="baud rates to simulate, 0 for no transmission time.")
+    parser.add_argument('--latency', type=float, nargs='+', default=[0], \
+            help="device reply latencies (seconds) to simulate.")
+    parser.add_argument('--programs', type=int, nargs='+', \
+            default=[1, 5, MAX_PROGRAMS], \
+            help="number of programs for load/save.")
+    parser.add_argument('--repeat', type=int, default=3, \
+            help="runs of each case, the best is kept.")
+    parser.add_argument('--output', type=argparse.FileType('w'), \
+            metavar="<filename>", help="store the results as JSON.")
+    parser.add_argument('--compare', type=argparse.FileType('r'), \
+            metavar="<filename>", help="compare with a JSON of a former run.")
+    args = parser.parse_args()
+
+    results = []
+
+    for baudrate in args.baudrate:
+        for latency in args.latency:
+            for name, n, setup, call in cases(args.programs):
+                r = measure(name, n, setup, call, baudrate or None, \
+                        latency, args.repeat)
+                results.append(r)
+
+                if not args.compare:
+                    print "%-16s %4s %6s %6s %8.4fs %6d sent %6d recv " \
+                            "%4d round trips" % (name, n or "", \
+                            baudrate or "", latency, r["wall"], \
+                            r["bytes_sent"], r["bytes_received"], \
+                            r["round_trips"])
+
+    if args.compare:
+        compare(results, json.load(args.compare))
+        args.compare.close()
+
+    if args.output:
+        json.dump({"version": opengarden.__version__, "date": time.time(), \
+                "results": results}, args.output, indent=1)
+        args.output.close()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -28,7 +28,14 @@ Alessandro Dotti Contra, GUI developer.
 
 import argparse
 import sys
+import time
 from opengarden import OpenGarden
+from ogarden_daemon import Client
+from tsstore import Store
+from program import encode, encodeList, decodeList, MAX_PROGRAMS
+from schedule import Schedule, describe, upcoming
+from fleet import Fleet, read_inventory
+from script import Step, StepResult, parse, run
 
 parser = argparse.ArgumentParser(description='OpenGarden CLI.')
 parser.add_argument('--get-programs', type=argparse.FileType('w'), \
@@ -56,22 +63,99 @@ parser.add_argument('--sunsite', nargs='?', const='get', \
         and 2 is Shadow.")
 parser.add_argument('--temperature', action='store_true', \
         help="print the device's temperature.")
+parser.add_argument('--strict', action='store_true', \
+        help="Do not send programs which overlap on the same line.")
+parser.add_argument('--max-running', type=int, metavar="<n>", \
+        help="Do not send programs which run more than <n> at once.")
+parser.add_argument('--store', metavar="<directory>", \
+        help="also append the temperature and the alarm to the history \
+        kept in the directory (see tsstore.py).")
 parser.add_argument('--queue', action='store_true', \
-        help="Print the queue list.")
+        help="Print the queue list, the next irrigations.")
+parser.add_argument('--limit', type=int, default=10, metavar="<n>", \
+        help="Print at most <n> irrigations in the queue list.")
+parser.add_argument('--until', type=long, metavar="<seconds>", \
+        help="Print the queue list of the next <seconds>.")
 parser.add_argument('--valve', nargs='?', const='get', \
         metavar="monostable/bistable", help="get/set valve type.")
-parser.add_argument('--device', default='/dev/ttyUSB0', required=True, \
+parser.add_argument('--watch', action='store_true', \
+        help="Print the device's log events until interrupted.")
+parser.add_argument('--log-prefix', metavar="<text>", \
+        help="The log lines of the device start with <text>.")
+parser.add_argument('--script', type=argparse.FileType('r'), \
+        metavar="<filename>", \
+        help="Run the operations in the file (- for stdin) over one \
+        connection and print a JSON line for each, see script.py.")
+parser.add_argument('--inventory', type=argparse.FileType('r'), \
+        metavar="<filename>", \
+        help="Run the --script on every device listed in the file.")
+parser.add_argument('--workers', type=int, default=8, \
+        help="Max number of devices handled at the same time.")
+parser.add_argument('--device', default='/dev/ttyUSB0', \
         help="ex. /dev/ttyUSB0 or /dev/ttyS0")
+parser.add_argument('--socket', metavar="<path>", \
+        help="use the device held by ogarden_daemon.py on this socket.")
 args = parser.parse_args()
 
-og = OpenGarden()
-og.connect(args.device)
+if args.script:
+    try:
+        steps = parse(args.script)
+    except ValueError as e:
+        parser.error("--script " + str(e))
+
+    args.script.close()
+elif args.inventory:
+    parser.error("--inventory needs --script")
+
+def report(results):
+    """ Print the step results, return True if all of them succeeded.
+    """
+
+    ok = True
+
+    for r in results:
+        print r.json()
+        ok = ok and r.error is None
+
+    return(ok)
+
+if args.script and args.inventory:
+    fleet = Fleet(read_inventory(args.inventory), args.workers)
+    args.inventory.close()
+    ok = True
 
-if og.version is None:
-    print "No Open Garden device connected or problems!"
-    raise "no device found error"
+    for r in fleet.run(lambda og: list(run(og, steps))):
+        if r.error is None:
+            for i in r.value:
+                i.device = r.device
+        else:
+            r.value = [StepResult(r.device, Step(0, "connect", []))]
+            r.value[0].error = r.error
+            r.value[0].elapsed = r.elapsed
+
+        ok = report(r.value) and ok
+
+    sys.exit(not ok)
+
+if args.socket:
+    og = Client(args.socket)
 else:
-    og.load()
+    og = OpenGarden()
+    og.log_events = args.watch
+    og.log_prefix = args.log_prefix
+    og.connect(args.device)
+
+if args.script:
+    ok = report(run(og, steps, args.socket or args.device))
+    og.disconnect()
+    sys.exit(not ok)
+
+# The device is asked only for what the options need.
+if args.get_version:
+    if og.version is None:
+        print "No Open Garden device connected or problems!"
+        raise NameError('NoConnect')
+
     print "Open garden device found."
     print "Serial number:", og.serial
     print "Software version:", og.version
@@ -82,6 +166,10 @@ if args.temperature:
     print "media 24h is: " + temperature[1]
     print "dfactor is: " + temperature[2]
 
+    if args.store:
+        Store(args.store).append(og.serial, time.time(), \
+                temperature + [og.get_alarm()])
+
 if args.sunsite:
     if args.sunsite == 'get':
         print "susite setup to: " + og.rt_load_sunsite()
@@ -117,13 +205,27 @@ if args.get_time:
     print "OG clock is: " + og.time()
 
 if args.queue:
-    print "Queue List: Not Yet Implemented"
+    now = int(og.time())
+
+    if args.until is None:
+        until = None
+    else:
+        until = now + args.until
+
+    print "Queue List:"
+
+    # the device clock is the local time, kept as UTC.
+    for start, end, line in upcoming(og.programs or [], now, until, \
+            args.limit):
+        print "  %s - %s line %d" % (time.strftime("%a %Y-%m-%d %H:%M", \
+                time.gmtime(start)), time.strftime("%H:%M", \
+                time.gmtime(end)), line)
 
 if args.get_programs:
     if og.programs:
         # args.get_programs.open()
 
-        for i in og.programs:
+        for i in encodeList(og.programs):
             args.get_programs.write(i)
             args.get_programs.write('\n')
 
@@ -132,13 +234,37 @@ if args.get_programs:
         print "No programs present in the device."
 
 if args.send_programs:
-    og.programs = args.send_programs.readlines()
+    programs = decodeList(args.send_programs.readlines())
+    args.send_programs.close()
+    schedule = Schedule(programs)
+    conflicts = schedule.overlapping_pairs()
+    refuse = False
 
-    for i in og.programs:
-        print i[3:].strip()
+    for conflict in conflicts:
+        print "Warning: " + describe(*conflict)
 
-    og.save()
-    args.send_programs.close()
+    if args.strict and conflicts:
+        refuse = True
+
+    if len(programs) > MAX_PROGRAMS:
+        print "Error: %d programs, the device stores %d" % \
+                (len(programs), MAX_PROGRAMS)
+        refuse = True
+
+    if args.max_running is not None and schedule.peak() > args.max_running:
+        print "Error: %d programs run at the same time, max is %d" % \
+                (schedule.peak(), args.max_running)
+        refuse = True
+
+    if refuse:
+        print "Error: programs not sent."
+    else:
+        og.programs = programs
+
+        for i in og.programs:
+            print encode(i)
+
+        og.save()
 
 if args.alarm:
     print "Alarm's lines: " + og.get_alarm()
@@ -152,6 +278,17 @@ if args.led:
     else:
         print "Led can be only ON or OFF"
 
+if args.watch:
+    if args.socket:
+        print "Error: the events cannot be watched through the daemon."
+    else:
+        try:
+            for t, text in og.events():
+                print time.strftime("%Y-%m-%d %H:%M:%S", \
+                        time.localtime(t)), text
+        except KeyboardInterrupt:
+            pass
+
 print "disconnecting the device"
 og.disconnect()
 del(og)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" OpenGarden connection daemon
+
+Keep the connection to the device open and serve the OpenGarden API
+to local clients through a unix socket, so they do not pay for the
+connection handshake on every run.
+
+The protocol is one JSON object per line:
+    {"call": "temperature", "args": []}
+    {"get": "serial"}
+    {"set": "sunsite", "value": "2"}
+answered with {"result": ...} or {"error": "..."}.
+
+Example:
+    ./ogarden_daemon.py --device /dev/ttyUSB0 --socket /tmp/ogarden.sock &
+    ./ogarden_cli.py --temperature --socket /tmp/ogarden.sock
+"""
+
+import argparse
+import os
+import sys
+import socket
+import json
+import threading
+import SocketServer
+from opengarden import OpenGarden
+from program import Program, decodeList, encode
+
+# What a client is allowed to do.
+METHODS = ("time", "temperature", "get_alarm", "load", "save",
+        "rt_load_sunsite", "rt_save_sunsite", "rt_load_valve",
+        "rt_save_valve", "rt_load_alarm_level", "rt_save_alarm_level",
+        "rt_load_led_setup", "rt_save_led_setup", "_load_programs",
+        "_save_programs", "_send_eepromload_cmd", "_send_eepromsave_cmd")
+ATTRIBUTES = ("version", "serial", "programs", "sunsite", "valve", "alarm",
+        "led")
+# What returns a list of programs, sent in the device format.
+PROGRAMS = ("programs", "_load_programs")
+
+def _str(value):
+    """ JSON strings come back as unicode, the API wants plain strings.
+    """
+
+    if isinstance(value, unicode):
+        return(str(value))
+    elif isinstance(value, list):
+        return([_str(i) for i in value])
+    else:
+        return(value)
+
+def _json(value):
+    """ Programs go on the socket in the device format.
+    """
+
+    if isinstance(value, Program):
+        return(encode(value))
+    elif isinstance(value, list):
+        return([_json(i) for i in value])
+    else:
+        return(value)
+
+def _remove_stale(path):
+    """ Remove the socket left by a daemon which is gone.
+    """
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+    else:
+        raise NameError('AlreadyRunning')
+    finally:
+        probe.close()
+
+class Daemon(SocketServer.ThreadingUnixStreamServer):
+    """ Serve a connected OpenGarden on a unix socket.
+
+    If the serial line fails the device is connected again on the
+    next request.
+
+    Keyword arguments:
+        path -- the unix socket.
+        device -- the serial port name.
+        mode -- permissions of the socket, by default only the user
+            running the daemon can drive the device.
+
+    NameError('AlreadyRunning') is raised if another daemon answers
+    on path.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, device, mode=0600):
+        self.device = device
+        self.og = None
+        self._connect_lock = threading.Lock()
+
+        if os.path.exists(path):
+            _remove_stale(path)
+
+        # the socket is created with the mode, it is never open to
+        # other users, not even for a moment.
+        umask = os.umask(0777 & ~mode)
+
+        try:
+            SocketServer.ThreadingUnixStreamServer.__init__(self, path,
+                    _Handler)
+        finally:
+            os.umask(umask)
+
+    def opengarden(self):
+        """ Return the connected OpenGarden, connecting if needed.
+
+        The handlers run in their own threads, only one of them opens
+        the port.
+        """
+
+        with self._connect_lock:
+            if self.og is None:
+                og = OpenGarden()
+                og.connect(self.device)
+                og.load()
+                self.og = og
+
+            return(self.og)
+
+    def request(self, req):
+        """ Run a request and return the reply.
+        """
+
+        try:
+            og = self.opengarden()
+
+            with og.lock:
+                if "call" in req and req["call"] in METHODS:
+                    args = _str(req.get("args", []))
+                    result = getattr(og, req["call"])(*args)
+                elif req.get("get") in ATTRIBUTES:
+                    result = getattr(og, req["get"])
+                elif req.get("set") in ATTRIBUTES:
+                    setattr(og, req["set"], _str(req["value"]))
+                    result = None
+                else:
+                    raise NameError('BadRequest')
+        except Exception as e:
+            # a bad request leaves the line as it was, anything else
+            # (ComError and Timeout included) may have broken it.
+            if not (isinstance(e, NameError) and e.args == ('BadRequest',)):
+                self.reset()
+
+            return({"error": str(e)})
+
+        return({"result": _json(result)})
+
+    def reset(self):
+        """ Disconnect the device, the next request connects it again.
+        """
+
+        with self._connect_lock:
+            og, self.og = self.og, None
+
+        if og is not None:
+            try:
+                og.disconnect()
+            except Exception:
+                pass
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+            except ValueError:
+                reply = {"error": "BadRequest"}
+            else:
+                reply = self.server.request(req)
+
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+class Client:
+    """ Stand in for OpenGarden which talks to the daemon.
+
+    It has the methods and attributes listed in METHODS and
+    ATTRIBUTES. Errors from the device are raised as NameError.
+
+    Example:
+        og = Client('/tmp/ogarden.sock')
+        print og.serial, og.temperature()
+        og.disconnect()
+    """
+
+    def __init__(self, path):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        self.__dict__['_sock'] = s
+        self.__dict__['_file'] = s.makefile('rw')
+
+    def _request(self, req, programs=False):
+        self._file.write(json.dumps(req) + '\n')
+        self._file.flush()
+        line = self._file.readline()
+
+        if not line:
+            raise NameError('NoConnect')
+
+        reply = json.loads(line)
+
+        if "error" in reply:
+            raise NameError(reply["error"])
+
+        result = _str(reply["result"])
+
+        if programs and result is not None:
+            result = decodeList(result)
+
+        return(result)
+
+    def __getattr__(self, name):
+        if name in METHODS:
+            return(lambda *args: self._request({"call": name, "args": args},
+                name in PROGRAMS))
+        elif name in ATTRIBUTES:
+            return(self._request({"get": name}, name in PROGRAMS))
+        else:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in ATTRIBUTES:
+            self._request({"set": name, "value": _json(value)})
+        else:
+            self.__dict__[name] = value
+
+    def disconnect(self):
+        """ Close the connection to the daemon, the device stays
+        connected.
+        """
+
+        self._file.close()
+        self._sock.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='OpenGarden daemon.')
+    parser.add_argument('--device', default='/dev/ttyUSB0', \
+            help="ex. /dev/ttyUSB0 or /dev/ttyS0")
+    parser.add_argument('--socket', default='/tmp/ogarden.sock', \
+            metavar="<path>", help="unix socket to listen on.")
+    parser.add_argument('--mode', default='0600', metavar="<octal>", \
+            help="permissions of the socket, 0600 by default.")
+    args = parser.parse_args()
+
+    try:
+        server = Daemon(args.socket, args.device, int(args.mode, 8))
+    except NameError as e:
+        print "Error: %s on %s" % (e, args.socket)
+        sys.exit(1)
+
+    server.opengarden()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.reset()
+    os.unlink(args.socket)
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" OpenGarden fleet command line interface
+
+Run the same operation on all the devices listed in an inventory file.
+"""
+
+import argparse
+import os
+import time
+from fleet import Fleet, read_inventory
+from program import encodeList
+from proglib import Library
+
+parser = argparse.ArgumentParser(description='OpenGarden fleet CLI.')
+parser.add_argument('--inventory', type=argparse.FileType('r'), \
+        required=True, metavar="<filename>", \
+        help="File with the devices, one per line.")
+parser.add_argument('--workers', type=int, default=8, \
+        help="Max number of devices handled at the same time.")
+parser.add_argument('--get-time', action='store_true', \
+        help="Print the abstime of every device.")
+parser.add_argument('--set-time', type=long, nargs='?', const=0, \
+        metavar="<seconds>", \
+        help="Set the abstime of every device, host time if not given.")
+parser.add_argument('--temperature', action='store_true', \
+        help="Print the temperature of every device.")
+parser.add_argument('--alarm', action='store_true', \
+        help="Print the alarm's lines status (ON/OFF) of every device.")
+parser.add_argument('--get-programs', metavar="<directory>", \
+        help="Download the programs of every device to <serial>.csv files.")
+parser.add_argument('--send-programs', type=argparse.FileType('r'), \
+        metavar="<filename>", \
+        help="Upload the programs in the file to every device.")
+parser.add_argument('--library', metavar="<directory>", \
+        help="The program library, see proglib.py.")
+parser.add_argument('--compare', nargs='?', const='', metavar="<name|hash>", \
+        help="Match the programs of every device against the library, " \
+        "or list the devices not running the given set.")
+parser.add_argument('--queue', type=int, nargs='?', const=10, \
+        metavar="<n>", help="Print the next <n> irrigations of every device.")
+parser.add_argument('--scale-programs', type=float, metavar="<percent>", \
+        help="Change the length of the programs to <percent> of it.")
+parser.add_argument('--shift-programs', type=int, metavar="<minutes>", \
+        help="Move the start of the programs by <minutes>.")
+parser.add_argument('--line', type=int, metavar="0..7", \
+        help="Scale or shift only the programs of this line.")
+args = parser.parse_args()
+
+if args.compare is not None and not args.library:
+    parser.error("--compare needs --library")
+
+fleet = Fleet(read_inventory(args.inventory), args.workers)
+args.inventory.close()
+
+def report(title, results, fmt=str):
+    print title
+
+    for r in results:
+        if r.error is None:
+            print "  %s [%s] %s (%.2fs)" % (r.device, r.serial, \
+                    fmt(r.value), r.elapsed)
+        else:
+            print "  %s [%s] ERROR %s (%.2fs)" % (r.device, r.serial, \
+                    r.error, r.elapsed)
+
+if args.set_time is not None:
+    report("set time:", fleet.set_time(args.set_time or None))
+
+if args.get_time:
+    report("OG clock:", fleet.get_time())
+
+if args.temperature:
+    report("temperature [now, media 24h, dfactor]:", fleet.temperature(), \
+            lambda t: ", ".join(t))
+
+if args.alarm:
+    report("Alarm's lines:", fleet.alarm())
+
+if args.send_programs:
+    programs = args.send_programs.readlines()
+    args.send_programs.close()
+    try:
+        results = fleet.send_programs(programs)
+    except ValueError as e:
+        print "send programs:"
+        print "  Error: %s, programs not sent." % e
+    else:
+        report("send programs:", results, lambda p: "%d programs" % len(p))
+
+if args.scale_programs is not None or args.shift_programs is not None:
+    def edit(table):
+        if args.scale_programs is not None:
+            table.scale(args.scale_programs / 100.0, args.line)
+
+        if args.shift_programs is not None:
+            table.shift(args.shift_programs, args.line)
+
+    report("edit programs:", fleet.edit_programs(edit), \
+            lambda p: "%d programs" % len(p))
+
+if args.queue:
+    report("queue list:", fleet.queue(args.queue), lambda q: ", ".join( \
+            ["%s line %d" % (time.strftime("%a %H:%M", time.gmtime(start)), \
+            line) for start, end, line in q]))
+
+if args.compare is not None:
+    library = Library(args.library)
+    results = fleet.programs_digest()
+
+    if args.compare:
+        wanted = library.resolve(args.compare)
+        results = [r for r in results \
+                if r.error is not None or r.value != wanted]
+        title = "not on %s:" % args.compare
+    else:
+        title = "program sets:"
+
+    def name(key):
+        if key not in library:
+            return("%s (not in library)" % key[:12])
+
+        return(" ".join([key[:12]] + library.name(key)))
+
+    report(title, results, name)
+
+if args.get_programs:
+    results = fleet.get_programs()
+
+    for r in results:
+        if r.error is None:
+            f = open(os.path.join(args.get_programs, r.serial + '.csv'), 'w')
+
+            for i in encodeList(r.value):
+                f.write(i)
+                f.write('\n')
+
+            f.close()
+
+    report("get programs:", results, lambda p: "%d programs" % len(p))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
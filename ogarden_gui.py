@@ -25,7 +25,11 @@ import subprocess
 import ConfigParser
 import locale
 import gettext
-from program import program
+import threading
+import Queue
+from program import Program, MAX_PROGRAMS, dayMask
+from schedule import Schedule
+import datfile
 from opengarden import *
 
 #====================
@@ -56,7 +60,7 @@ appliance = OpenGarden() #The appliance
 device = None #Which port the appliance is connected to
 
 isConnected = False #Connection with the appliance
-maxPrograms = 19 #Maximum nuber of programs the appliance can store
+maxPrograms = MAX_PROGRAMS #Maximum nuber of programs the appliance can store
 selectedProgram = False #Track which program is being currently selected
 toSave = False #Track if the list of programs needs to be saved
 toSync = False #Track if the list of programs nedds to be synced
@@ -67,13 +71,22 @@ gui = False #Configure GUI form
 test = False #Test appliace form
 note = False #Note editor window
 
+deviceJobs = Queue.Queue() #Appliance I/O waiting for the worker thread
+deviceResults = Queue.Queue() #Callbacks from the worker to the main loop
+pendingJobs = 0 #Appliance I/O queued and not completed yet
+
+statusSample = None #Latest appliance status read, see readStatus()
+statusPending = False #A status request is queued
+statusTimer = None #Next status refresh
+statusInterval = 60 #Seconds between two status refreshes
+
 programs = [] #List of programs
 noteContent = '' #Notes associated with programs
+noteFile = None #Data file the notes are still to be read from
 
 days = (_("sun"),_("mon"),_("tue"),_("wed"),_("thu"),_("fri"),_("sat"))
 valveSettings = {"bistable":_("Bistable BATT"), "monostable":"24Vac"}
 alarmSettings = {"HIGH":"HIGH = N.C.", "LOW":"LOW = N.O."}
-noteMarker = "#Notes begin here\n"
 tempSettings = {'celsius':'Celsius','fahrenheit':'Fahrenheit'}
 displayTemp = "celsius" #Display temperatures in celsius degrees by default
 
@@ -92,12 +105,17 @@ def exit():
     """
     Exit program
     """
-    global isConnected,toSave
+    global isConnected
 
     #Check if the appliance is connected, then disconnect
     if isConnected:
-        disconnect()
-    
+        disconnect(finishExit)
+    else:
+        finishExit()
+
+def finishExit():
+    """ Exit program, once the appliance is disconnected
+    """
     #Check if the programs list needs to be saved
     if toSave:
         if askSave():
@@ -108,47 +126,73 @@ def exit():
 def connect():
     """ Connect the appliance, Sync time and get the stored programs list and check alarms
     """
-    global isConnected,appliance,device,programs,toSave
+    disableButton(connectButton)
+    connectLabel.configure(text=_("Connecting..."))
+    applianceJob(openAppliance, applianceConnected, connectFailed)
 
-    try:
-        appliance.connect(device)
-    except:
-        showError(_("Unable to connect to the appliance"))
-        isConnected = False
-    else:
-        if not appliance.version:
-            showError(_("Unknown appliance"))
-        else:
-            isConnected = True
+def openAppliance():
+    """ Connect the appliance and read its setup (worker thread).
 
-            #Get appliance's information
-            appliance.load()
+    Return None if it is not an appliance, its programs and status
+    otherwise.
+    """
+    appliance.connect(device)
+    if not appliance.version or not appliance.serial:
+        return None
 
-            #Sync appliance's time
-            appliance.time(calendar.timegm(time.localtime()))
+    #Get appliance's information
+    appliance.load()
 
-            #Check if the programs list needs to be saved
-            if toSave:
-                if askSave():
-                    savePrograms()
+    #Sync appliance's time
+    appliance.time(calendar.timegm(time.localtime()))
 
-            #Load programs
-            programs = decodePrograms(appliance.programs)
-            loadPrograms()
-            enableButton(configureButton)
-            enableButton(testButton)
-            if len(programs) > 0:
-                enableButton(saveButton)
-            disableButton(syncButton)
+    return (list(appliance.programs or []), readStatus())
 
-            #Check alarms
-            setAlarmStatus(appliance.get_alarm())
-            enableButton(alarmButton)
+def applianceConnected(result):
+    """ Show the appliance once connected
+    """
+    global isConnected,programs
+
+    enableButton(connectButton)
+
+    if result is None:
+        showError(_("Unknown appliance"))
+    else:
+        isConnected = True
+
+        #Check if the programs list needs to be saved
+        if toSave:
+            if askSave():
+                savePrograms()
+
+        #Load programs
+        programs, sample = result
+        loadPrograms()
+        enableButton(configureButton)
+        enableButton(testButton)
+        if len(programs) > 0:
+            enableButton(saveButton)
+        disableButton(syncButton)
+
+        #Show the status and keep it up to date
+        storeStatus(sample)
+        scheduleStatus()
+        enableButton(alarmButton)
 
     setConnectorStatus()
 
-def disconnect():
-    """ Disconnect the appliance
+def connectFailed(error):
+    """ Report a failed connection
+    """
+    global isConnected
+
+    showError(_("Unable to connect to the appliance"))
+    isConnected = False
+    enableButton(connectButton)
+    setConnectorStatus()
+
+def disconnect(then=None):
+    """ Disconnect the appliance, then call then() if given
     """
     global isConnected, toSync
 
@@ -157,17 +201,34 @@ def disconnect():
         if askSync():
             syncAppliance()
 
-    appliance.disconnect()
     isConnected = False
-    setConnectorStatus()
-    setAlarmStatus(None)
+    scheduleStatus()
 
     #Disable buttons
+    disableButton(connectButton)
     disableButton(configureButton)
     disableButton(testButton)
     disableButton(syncButton)
     disableButton(alarmButton)
 
+    #The sync, if any, is completed first
+    applianceJob(appliance.disconnect, \
+            lambda result: applianceDisconnected(then), \
+            lambda error: applianceDisconnected(then))
+
+def applianceDisconnected(then):
+    """ Show the appliance disconnected
+    """
+    global statusSample
+
+    enableButton(connectButton)
+    setConnectorStatus()
+    statusSample = None
+    showStatus()
+
+    if then:
+        then()
+
 def addProgram():
     """ Add a new program
     """
@@ -205,8 +266,7 @@ def processProgram(action):
     create/update a program.
     """
     data = validateProgram()
-    if data:
-        storeProgram(action,data)
+    if data and storeProgram(action,data) is not False:
         form.destroy()
 
 def checkDay(day):
@@ -219,15 +279,17 @@ def storeProgram(action,data):
     """
     global programs,selectedProgram
 
+    p = Program(data['start'], data['length'], \
+            dayMask([days.index(day) for day in data['days']]), \
+            data['line'] - 1)
+
+    #Warn if the program overlaps another one of the same line
     if action == "add":
-        p = program()
+        conflicts = Schedule(programs).conflicts_with(p)
     else:
-        p = programs[selectedProgram]
-
-    p.startTime(data['start'])
-    p.length(data['length'])
-    p.line(data['line'])
-    p.days(data['days'])
+        conflicts = Schedule(programs).conflicts_with(p, selectedProgram)
+    if conflicts and not askOverlap(conflicts):
+        return False
 
     if action == "add":
         programs.append(p)
@@ -270,29 +332,24 @@ def deleteProgram():
 def savePrograms():
     """ Save the current programs list to file.
     """
-    global programs, toSave, noteContent, noteMarker
+    global programs, toSave
 
     fileName = tkFileDialog.asksaveasfilename(title=_("Save programs"),filetypes=[(_("Data"),"*.dat")])
     if len(fileName) > 0:
+        #The notes may come from the file being overwritten
+        notes = loadNotes()
         try:
-            f = open(fileName, "wb")
+            datfile.write(fileName, programs, notes)
         except:
             showError(_("Can't save data file"))
             return
-        #Save programs
-        for program in encodePrograms(programs):
-            f.write(program)
-        #Save notes
-        f.write(noteMarker)
-        f.write(noteContent)
-        f.close()
         disableButton(saveButton)
         toSave = False
 
 def readPrograms():
     """ Read a list of programs from a previously saved data file.
     """
-    global programs,isConnected,toSync,toSave,noteContent,noteMarker
+    global programs,isConnected,toSync,toSave,noteContent,noteFile
 
     if isConnected and toSync:
         if askSync():
@@ -305,28 +362,20 @@ def readPrograms():
     fileName = tkFileDialog.askopenfilename(title=_("Load programs"),filetypes=[(_("Data"),"*.dat")])
     if len(fileName) > 0:
         try:
-            f = open(fileName, "rb")
+            dat = datfile.DatFile(fileName)
+            plist = dat.programs()
         except:
             showError(_("Can't read data file"))
             return
-        lines = f.readlines()
-        plines = []        #Lines representing programs
-
-        #Separate programs and notes
-        storeProgram = True
-        for line in lines:
-            if line == noteMarker:
-                storeProgram = False
-                continue
-            if storeProgram:
-                plines.append(line)
-            else:
-                noteContent = noteContent + line
-        f.close()
-
-        #Decode programs (if any)
-        if plines:
-            programs = decodePrograms(plines)
+
+        #The notes are read when needed
+        if noteFile:
+            noteFile.close()
+        noteFile = dat
+        noteContent = None
+
+        if plist:
+            programs = plist
             loadPrograms()
             toSync = True
 
@@ -335,39 +384,159 @@ def syncAppliance():
     """
     global programs, toSync
 
-    appliance.programs = encodePrograms(programs)
-    appliance.save()
     toSync = False
-
     disableButton(syncButton)
 
-def configGui(tempOptions,temp):
+    #Send a copy, the list can be changed while it is sent
+    applianceJob(lambda p=list(programs): sendPrograms(p), \
+            lambda result: setConnectorStatus(), syncFailed)
+
+def sendPrograms(plist):
+    """ Send the programs to the appliance (worker thread).
+    """
+    appliance.programs = plist
+    appliance.save(lambda done, total: \
+            reportProgress(syncProgress, (done, total)))
+
+def syncProgress(progress):
+    """ Show how far the sync is
+    """
+    connectLabel.configure(text=_("Syncing %d/%d") % progress)
+
+def syncFailed(error):
+    """ Report a failed sync, the programs are still to be synced
+    """
+    global toSync
+
+    showError(_("Unable to sync the appliance"))
+    toSync = True
+    if isConnected:
+        enableButton(syncButton)
+    setConnectorStatus()
+
+def configGui(tempOptions,temp,interval):
     """ Config GUI
     """
     global gui
-    global displayTemp
+    global displayTemp, statusInterval
 
     displayTemp = setFromLabel(tempSettings,temp.get())
+
+    try:
+        seconds = int(interval.get())
+    except ValueError:
+        seconds = 0
+    if not 5 <= seconds <= 3600:
+        showError(_("Wrong status refresh: %s") % interval.get())
+        return
+
+    statusInterval = seconds
+    scheduleStatus()
+    showStatus()
     gui.destroy()
 
 def configAppliance(site,siteOptions,valve,led,alarm):
     """ Config the appliance
     """
-    global appliance
     global config
 
-    appliance.sunsite = siteOptions.index(site.get())
-    appliance.valve = setFromLabel(valveSettings,valve.get())
-    appliance.led = led.get()
-    appliance.alarm = setFromLabel(alarmSettings,alarm.get())
-    appliance.save()
+    settings = (siteOptions.index(site.get()), \
+            setFromLabel(valveSettings,valve.get()), led.get(), \
+            setFromLabel(alarmSettings,alarm.get()))
+    applianceJob(lambda: saveConfig(*settings), \
+            failed=lambda error: showError(_("Unable to configure the appliance")))
     config.destroy()
 
+def saveConfig(sunsite, valve, led, alarm):
+    """ Send the configuration to the appliance (worker thread).
+    """
+    appliance.sunsite = sunsite
+    appliance.valve = valve
+    appliance.led = led
+    appliance.alarm = alarm
+    appliance.save()
+
 def checkAlarms():
     """ Check if there are active alarms
     """
-    global appliance
-    setAlarmStatus(appliance.get_alarm())
+    requestStatus()
+
+def readStatus():
+    """ Read the appliance status (worker thread).
+    """
+    return {'taken': time.time(), 'time': int(appliance.time()), \
+            'temperature': appliance.temperature(), \
+            'alarm': appliance.get_alarm()}
+
+def requestStatus():
+    """ Ask the appliance for its status, unless a request is already
+    queued: the views are updated when it arrives.
+    """
+    global statusPending
+
+    if statusPending or not isConnected:
+        return
+
+    statusPending = True
+    applianceJob(readStatus, storeStatus, statusFailed)
+
+def storeStatus(sample):
+    """ Keep the status just read and show it
+    """
+    global statusPending, statusSample
+
+    statusPending = False
+    if isConnected:
+        statusSample = sample
+        showStatus()
+
+def statusFailed(error):
+    """ Keep the last status, the next refresh will try again
+    """
+    global statusPending
+
+    statusPending = False
+    statusLabel.configure(text=_("Status not available"))
+
+def scheduleStatus():
+    """ Refresh the status every statusInterval seconds while connected
+    """
+    global statusTimer
+
+    if statusTimer:
+        mainWindow.after_cancel(statusTimer)
+        statusTimer = None
+
+    if isConnected:
+        statusTimer = mainWindow.after(statusInterval * 1000, refreshStatus)
+
+def refreshStatus():
+    """ The status refresh timer
+    """
+    global statusTimer
+
+    statusTimer = None
+    requestStatus()
+    scheduleStatus()
+
+def applianceClock():
+    """ Return the appliance time, from the latest status.
+    """
+    return statusSample['time'] + int(time.time() - statusSample['taken'])
+
+def showStatus():
+    """ Display the latest status in the status bar
+    """
+    if statusSample is None:
+        statusLabel.configure(text="")
+        setAlarmStatus(None)
+        return
+
+    temperature = statusSample['temperature']
+    statusLabel.configure(text=_("Temperature %s (24h avg. %s) - Appliance clock %s") % \
+            (ogTemp(temperature[0]), ogTemp(temperature[1]), \
+            time.strftime("%d %b %Y %H:%M", time.gmtime(statusSample['time']))))
+    setAlarmStatus(statusSample['alarm'])
 
 def openNoteEditor():
     """ Open the note editor
@@ -386,7 +555,7 @@ def openNoteEditor():
     scroll.grid(row=0, column=3, sticky=N+S)
 
     #Display note content
-    text.insert(END,noteContent)
+    text.insert(END,loadNotes())
     text.focus()
 
     #Disable Notes button
@@ -396,6 +565,23 @@ def openNoteEditor():
     note.protocol("WM_DELETE_WINDOW", closeNoteEditor)
     note.bind('<Key>', lambda event, widget = text: storeNoteContent(event,widget))
 
+def loadNotes():
+    """ Return the notes, reading them from the data file if they
+    were not read yet.
+    """
+    global noteContent, noteFile
+
+    if noteContent is None:
+        try:
+            noteContent = noteFile.notes()
+        except:
+            showError(_("Can't read data file"))
+            noteContent = ''
+        noteFile.close()
+        noteFile = None
+
+    return noteContent
+
 def closeNoteEditor():
     """ Close the note editor
     """
@@ -532,13 +718,13 @@ def displayProgramForm(action, program=None):
 
     #In case of edit request, load the form with the appropriate values
     if program:
-        (hour,minute) = program.startTime().split(':')
+        (hour,minute) = divmod(program.start, 60)
         startHourSpin.delete(0,END)
         startHourSpin.insert(0,hour)
         startMinuteSpin.delete(0,END)
         startMinuteSpin.insert(0,minute)
 
-        length = int(program.length())
+        length = program.length
         hours = length / 60
         minutes = length % 60
         lengthHourSpin.delete(0,END)
@@ -547,10 +733,10 @@ def displayProgramForm(action, program=None):
         lengthMinuteSpin.insert(0,minutes)
 
         lineSpin.delete(0,END)
-        lineSpin.insert(0,program.line())
+        lineSpin.insert(0,program.line + 1)
 
-        for day in program.days():
-            form.nametowidget(day).invoke()
+        for day in program.weekdays():
+            form.nametowidget(days[day]).invoke()
 
     makeModal(form,mainWindow)
 
@@ -571,23 +757,54 @@ def displayGuiForm():
     tempMenu = OptionMenu(gui, tempVar, *tempOptions)
     tempMenu.grid(row=0, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
 
+    #Status refresh interval
+    intervalLabel = Label(gui, text=_("Status refresh (seconds)"))
+    intervalLabel.grid(row=1, column=0, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
+    intervalSpin = Spinbox(gui, width=(fmtButtonWidth - fmtPadding)/2, from_=5, to=3600, increment=5, justify=RIGHT)
+    intervalSpin.delete(0,END)
+    intervalSpin.insert(0,statusInterval)
+    intervalSpin.grid(row=1, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
+
     #Apply button
-    applyButton = Button(gui, width=fmtButtonWidth, text=_("Apply"), command=(lambda: configGui(tempSettings,tempVar)))
-    applyButton.grid(row=1, column=0, padx=fmtPadding, pady=fmtPadding)
+    applyButton = Button(gui, width=fmtButtonWidth, text=_("Apply"), command=(lambda: configGui(tempSettings,tempVar,intervalSpin)))
+    applyButton.grid(row=2, column=0, padx=fmtPadding, pady=fmtPadding)
 
     #Cancel button
     cancelButton = Button(gui, width=fmtButtonWidth, text=_("Cancel"), command=closeGuiForm)
-    cancelButton.grid(row=1, column=1, padx=fmtPadding, pady=fmtPadding)
+    cancelButton.grid(row=2, column=1, padx=fmtPadding, pady=fmtPadding)
 
     makeModal(gui,mainWindow)
 
 def displayConfigForm():
-    """ Display the form to configure the appliance
+    """ Display the form to configure the appliance, once its setup
+    is read
+    """
+    applianceJob(lambda: readConfig(statusSample is None), buildConfigForm)
+
+def readConfig(withStatus):
+    """ Read the setup shown by the configuration form (worker thread).
+
+    The setup is cached since the connection, the status is read only
+    if there is none yet.
+    """
+    info = {'version': appliance.version, 'serial': appliance.serial, \
+            'sunsite': appliance.sunsite, 'valve': appliance.valve, \
+            'led': appliance.led, 'alarm': appliance.alarm}
+    if withStatus:
+        info['status'] = readStatus()
+    return info
+
+def buildConfigForm(info):
+    """ Build the form to configure the appliance
     """
     global config
-    global appliance
     global displayTemp
 
+    if 'status' in info:
+        storeStatus(info['status'])
+    if statusSample is None:
+        return
+
     config = Toplevel(mainWindow)
     config.title(_("Configure appliance"))
 
@@ -596,14 +813,14 @@ def displayConfigForm():
     #Appliance's version
     idLabel = Label(config, text=_("Appliance version"))
     idLabel.grid(row=row, column=0, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
-    idValueLabel = Label(config, text=appliance.version)
+    idValueLabel = Label(config, text=info['version'])
     idValueLabel.grid(row=row, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
     row+=1
 
     # Appliance's serial number
     idLabel = Label(config, text=_("Serial number"))
     idLabel.grid(row=row, column=0, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
-    idValueLabel = Label(config, text=appliance.serial)
+    idValueLabel = Label(config, text=info['serial'])
     idValueLabel.grid(row=row, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
     row+=1
 
@@ -612,13 +829,13 @@ def displayConfigForm():
     idLabel.grid(row=row, column=0, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
     idValueLabel = Label(config, \
             text=time.strftime("%d %b %Y %H:%M:%S", \
-            time.gmtime(int(appliance.time()))))
+            time.gmtime(applianceClock())))
     idValueLabel.grid(row=row, column=1, padx=fmtPadding, \
             pady=fmtPadding, sticky=N+W)
     row+=1
 
     #Temperature
-    temperature = appliance.temperature()
+    temperature = statusSample['temperature']
 
     tempLabel = Label(config, text=_("Temperature"))
     tempLabel.grid(row=row, column=0, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
@@ -652,7 +869,7 @@ def displayConfigForm():
                 _("15 to 25 degrees"))
 
     siteVar = StringVar()
-    siteVar.set(siteOptions[int(appliance.sunsite)])
+    siteVar.set(siteOptions[int(info['sunsite'])])
     siteMenu = OptionMenu(config, siteVar, *siteOptions)
     siteMenu.grid(row=row, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
     row+=1
@@ -663,7 +880,7 @@ def displayConfigForm():
 
     valveOptions = valveSettings.values()
     valveVar = StringVar()
-    valveVar.set(valveSettings[appliance.valve])
+    valveVar.set(valveSettings[info['valve']])
     valveMenu = OptionMenu(config, valveVar, *valveOptions)
     valveMenu.grid(row=row, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
     row+=1
@@ -674,7 +891,7 @@ def displayConfigForm():
 
     ledOptions =("ON", "OFF")
     ledVar = StringVar()
-    ledVar.set(appliance.led)
+    ledVar.set(info['led'])
     ledMenu = OptionMenu(config, ledVar, *ledOptions)
     ledMenu.grid(row=row, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
     row+=1
@@ -685,7 +902,7 @@ def displayConfigForm():
 
     alarmOptions = alarmSettings.values()
     alarmVar = StringVar()
-    alarmVar.set(alarmSettings[appliance.alarm])
+    alarmVar.set(alarmSettings[info['alarm']])
     alarmMenu = OptionMenu(config, alarmVar, *alarmOptions)
     alarmMenu.grid(row=row, column=1, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
     row+=1
@@ -748,7 +965,7 @@ def validateProgram():
     startHour = int(form.nametowidget("startHour").get())
     startMinute = int(form.nametowidget("startMinute").get())
     if 0 <= startHour <= 23 and 0 <= startMinute <= 59:
-        data['start'] = str(startHour).zfill(2) + ":" + str(startMinute).zfill(2)
+        data['start'] = startHour * 60 + startMinute
     else:
         showError(_("Wrong start time: %s:%s") % (startHour, startMinute))
         return False
@@ -756,14 +973,14 @@ def validateProgram():
     lengthHours = int(form.nametowidget("lengthHours").get())
     lengthMinutes = int(form.nametowidget("lengthMinutes").get())
     if (0 <= lengthHours <= 23 and 1 <= lengthMinutes <=59) or (1 <= lengthHours <= 23 and 0 <= lengthMinutes <=59):
-        data['length'] = str(lengthHours * 60 + lengthMinutes)
+        data['length'] = lengthHours * 60 + lengthMinutes
     else:
         showError(_("Wrong duration: %s:%s") % (lengthHours, lengthMinutes))
         return False
 
     line = int(form.nametowidget("line").get())
     if 1 <= line <= 8:
-        data['line'] = str(line)
+        data['line'] = line
     else:
         showError(_("Wrong line number: %s") % line)
         return False
@@ -788,7 +1005,7 @@ def loadPrograms():
     #Load programs list (empty it first)
     programsList.delete(0, END)
     for p in programs:
-        programsList.insert(END, p.asString())
+        programsList.insert(END, programString(p))
 
     #If we have the maximum number of programs already, prevent new programs
     #from being created
@@ -802,74 +1019,31 @@ def loadPrograms():
     if isConnected:
         enableButton(syncButton)
 
-def decodePrograms(programs):
-    """ Decode programs read from the appliance.
-    Programs are stored as comma separated strings,
-    each field having the following meaning:
-
-    0 - the id
-    1 - start time (four digits, two for the hour and two for the minutes)
-    2 - duration in minutes
-    3 - days of week (hex bitmapped)
-    4 - output line
-
-    Returns an array of program objects.
+def programString(program):
+    """ Return a program as a string for the programs list.
     """
     global days
 
-    prgs = []
-
-    for prog in programs:
-        p = program()
-        data = prog.split(',')
-        p.startTime(data[1][:2]+':'+data[1][2:])
-        p.length(int(data[2]))
-        p.line(int(data[4])+1)
-
-        d = []
-        for n,i in enumerate(days):
-            if (2**n) & int(data[3], 16):
-                d.append(i)
-
-        p.days(d)
-        prgs.append(p)
-
-    return prgs
-
-def encodePrograms(programs):
-    """ Encode programs in an appliance supported format.
-    See decodePrograms for format details.
-
-    Returns an array of encoded program strings.
-    """
-    global days
-    prgs = []
-
-    for program in programs:
-        i = 0
-        #Bitmap the days
-        d = 0
-        for day in program.days():
-            i = days.index(day)
-            d = d | 2**i
-
-        #Create the encoded program string
-        p = "%02d,%s,%03d,%2s,%d\n" % (i, \
-            "".join(program.startTime().split(':')), \
-            int(program.length()), \
-            hex(d)[2:], \
-            int(program.line())-1)
-
-        prgs.append(p)
-        i += 1
-
-    return prgs
+    string = _("%s (%3s) - line %s ") % (program.startTime(), \
+            program.length, program.line + 1)
+    string += "[ "
+    for day in program.weekdays():
+        string += "%s " % (days[day])
+    string += "]"
+    return string
 
 def askSync():
     """ Ask the user if the program list has to be synced.
     """
     return tkMessageBox.askyesno(_("Warning!"), _("Programs list was modified. Sync anyway?"))
 
+def askOverlap(conflicts):
+    """ Ask the user if a program overlapping others has to be stored.
+    """
+    overlaps = ", ".join(["%s (%s)" % (programString(programs[n]), days[day]) \
+            for day, n in conflicts])
+    return tkMessageBox.askyesno(_("Warning!"), _("The program overlaps %s. Store anyway?") % overlaps)
+
 def askSave():
     """ Ask the user if the program list has to be saved.
     """
@@ -879,7 +1053,6 @@ def createTestPrograms():
     """ Create a set of programs to test the appliance.
     WARNING: this will delete the current programs and reset the appliance.
     """
-    global programs, days, toSave
 
     #Get test start time 
     startHour = int(test.nametowidget("startHour").get())
@@ -894,13 +1067,20 @@ def createTestPrograms():
         showError(_("Wrong test duration: %s") % length)
         return False
 
-    #Get appliance time and calculate if the test is today or tomorrow.
+    storeTestPrograms(startHour, startMinute, length, applianceClock())
+
+def storeTestPrograms(startHour, startMinute, length, now):
+    """ Store and sync the test programs, now is the appliance time.
+    """
+    global programs, days, toSave
+
+    #Calculate if the test is today or tomorrow.
     #If test time is earlier than current appliance time test will be performed
     #tomorrow
 
     day = None
 
-    now = time.gmtime(float(appliance.time()))
+    now = time.gmtime(float(now))
 
     if startHour < now[3]:
         day = now[6] + 1
@@ -918,7 +1098,7 @@ def createTestPrograms():
     #Create test programs
     for i in range(8):
         data = {}
-        data['start'] = str(startHour).zfill(2) + ":" + str(startMinute).zfill(2)
+        data['start'] = startHour * 60 + startMinute
         data['length'] = length
         data['line'] = i+1
         data['days'] = (days[day],)
@@ -962,6 +1142,62 @@ def setFromLabel(settings,value):
             return setting
     return None
 
+#====================
+# Appliance worker
+#====================
+
+def applianceJob(job, done=None, failed=None):
+    """ Run job() on the worker thread, so that the appliance I/O never
+    blocks the main loop. Then done(result), or failed(error), is
+    called on the main loop. The jobs run one at a time, in order.
+    """
+    global pendingJobs
+
+    if failed is None:
+        failed = lambda error: showError(_("Appliance error: %s") % error)
+
+    pendingJobs += 1
+    mainWindow.configure(cursor="watch")
+    deviceJobs.put((job, done, failed))
+
+def applianceWorker():
+    """ The worker thread, the only one which talks to the appliance.
+    """
+    while True:
+        job, done, failed = deviceJobs.get()
+        try:
+            result = job()
+        except Exception as e:
+            deviceResults.put((failed, e, True))
+        else:
+            deviceResults.put((done, result, True))
+
+def reportProgress(callback, value):
+    """ Call callback(value) on the main loop while a job runs.
+    """
+    deviceResults.put((callback, value, False))
+
+def processResults():
+    """ Run the callbacks of the worker on the main loop.
+    """
+    global pendingJobs
+
+    mainWindow.after(50, processResults)
+
+    while True:
+        try:
+            (callback, value, completed) = deviceResults.get_nowait()
+        except Queue.Empty:
+            break
+
+        if completed:
+            pendingJobs -= 1
+            if not pendingJobs:
+                mainWindow.configure(cursor="")
+
+        if callback:
+            callback(value)
+
 #====================
 # The main window
 #====================
@@ -1000,6 +1236,8 @@ syncButton = Button(width=fmtButtonWidth, text=_("Sync appliance"), command=sync
 #Programs list widget
 programsList = Listbox(height=maxPrograms, selectmode=SINGLE)
 programsList.bind("<<ListboxSelect>>", selectedProgram)
+#Appliance status bar, refreshed in the background
+statusLabel = Label()
 #Alarms status bar
 alarmStatus = Label()
 alarmButton = Button(text=_("Check alarms"), command=checkAlarms, width=fmtButtonWidth)
@@ -1023,6 +1261,7 @@ programsList.grid(row=2, column=0, columnspan=4, padx=fmtPadding, pady=fmtPaddin
 alarmStatus.grid(row=4, column=0, columnspan=3, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
 alarmButton.grid(row=4, column=2, padx=fmtPadding, pady=fmtPadding)
 testButton.grid(row=4, column=3, padx=fmtPadding, pady=fmtPadding)
+statusLabel.grid(row=5, column=0, columnspan=4, padx=fmtPadding, pady=fmtPadding, sticky=N+W)
 
 #Set interface initial status
 setConnectorStatus()
@@ -1042,6 +1281,13 @@ disableButton(alarmButton)
 
 device = probeDevice(platform.system())
 
+# Start the appliance worker
+
+worker = threading.Thread(target=applianceWorker)
+worker.daemon = True
+worker.start()
+mainWindow.after(50, processResults)
+
 # Start GUI
 
 mainWindow.mainloop()
@@ -26,9 +26,287 @@ Andrea Marabini, the electronic designer.
 Alessandro Dotti Contra, GUI developer.
 """
 
+import time
+import atexit
+import weakref
+import threading
+import functools
+import bisect
+import Queue
 import serial
+from program import decode, decodeList, encode, MAX_PROGRAMS
 
-class OpenGarden:
+def _locked(method):
+    """ Run the method holding the device lock. """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+class ComError(NameError):
+    """ The device did not echo back the command we sent.
+
+    Attributes:
+        offset -- index of the first byte which did not match.
+        cmd -- the command sent.
+        echo -- what the device echoed back.
+    """
+
+    def __init__(self, offset, cmd, echo):
+        NameError.__init__(self, 'ComError', offset)
+        self.offset = offset
+        self.cmd = cmd
+        self.echo = echo
+
+    def __str__(self):
+        return "ComError at byte %d: sent %r, echo %r" % \
+                (self.offset, self.cmd, self.echo)
+
+class Timeout(NameError):
+    """ The device did not answer in time.
+
+    Attributes:
+        cmd -- the command sent.
+        stage -- "echo" or "reply", what was not received.
+    """
+
+    def __init__(self, cmd, stage):
+        NameError.__init__(self, 'Timeout', cmd, stage)
+        self.cmd = cmd
+        self.stage = stage
+
+    def __str__(self):
+        return "Timeout waiting the %s of %r" % (self.stage, self.cmd)
+
+class Histogram(object):
+    """ Latency histogram of the commands.
+
+    Each command is counted in the first bucket whose bound (seconds)
+    is not lower than its latency, the commands which timed out are
+    counted apart: a slow link moves the counts to the upper buckets,
+    a dead one adds timeouts.
+
+    Example:
+        print og.latency
+        print og.latency.percentile(95), og.latency.timeouts
+    """
+
+    bounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+            1, 2, 5, 10)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.timeouts = 0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def add_timeout(self):
+        self.timeouts += 1
+
+    def mean(self):
+        if self.count:
+            return(self.total / self.count)
+        else:
+            return(None)
+
+    def percentile(self, p):
+        """ Return the bound of the bucket holding the p percentile,
+        or the max latency if it is over the last bound.
+        """
+
+        if not self.count:
+            return(None)
+
+        n = 0
+
+        for i, c in enumerate(self.counts):
+            n += c
+
+            if n * 100.0 >= p * self.count:
+                break
+
+        if i < len(self.bounds):
+            return(self.bounds[i])
+        else:
+            return(self.max)
+
+    def __str__(self):
+        lines = []
+
+        for i, c in enumerate(self.counts):
+            if i < len(self.bounds):
+                lines.append("<= %6.3fs: %d" % (self.bounds[i], c))
+            else:
+                lines.append(" > %6.3fs: %d" % (self.bounds[-1], c))
+
+        lines.append("timeouts: %d" % self.timeouts)
+        return('\n'.join(lines))
+
+_readers = weakref.WeakSet()
+
+@atexit.register
+def _stop_readers():
+    """ Stop the readers left running, before the interpreter exits. """
+
+    for reader in list(_readers):
+        reader.stop()
+
+class _Reader(threading.Thread):
+    """ Frame the bytes received from the device into lines.
+
+    The thread reads whatever the port has, appends it to a buffer and
+    puts every complete line (with its line terminator) on the lines
+    queue. The echo of a command ends with \n\r, so the \r left at
+    the start of the next line is dropped. Commands get their echo and
+    reply lines from the queue, without a system call for each small
+    read.
+
+    Lines received while nobody holds lock are not part of a reply,
+    they are passed to on_log() and never queued. If log_prefix is set
+    the lines starting with it are the device log and go to on_log()
+    too, even in the middle of a reply.
+
+    Attributes:
+        lines -- the Queue of the lines received.
+        error -- the exception which stopped the thread, if any.
+    """
+
+    poll = 0.1
+
+    def __init__(self, port, lock, log_prefix=None, on_log=None):
+        threading.Thread.__init__(self, name="opengarden-reader")
+        self.daemon = True
+        self.port = port
+        self.lock = lock
+        self.log_prefix = log_prefix
+        self.on_log = on_log
+        self.lines = Queue.Queue()
+        self.running = True
+        self.error = None
+        self._buf = bytearray()
+        _readers.add(self)
+
+    def run(self):
+        buf = self._buf
+        self.port.timeout = self.poll
+
+        try:
+            while self.running:
+                data = self.port.read(self.port.inWaiting() or 1)
+
+                if not data:
+                    continue
+
+                buf.extend(data)
+                start = 0
+                end = buf.find('\n')
+
+                while end >= 0:
+                    line = str(buf[start:end + 1])
+
+                    if line.startswith('\r'):
+                        line = line[1:]
+
+                    if self.log_prefix and line.startswith(self.log_prefix):
+                        self.on_log(line)
+                    elif self.lock.acquire(False):
+                        # no command is waiting for it.
+                        try:
+                            self.on_log(line)
+                        finally:
+                            self.lock.release()
+                    else:
+                        self.lines.put(line)
+
+                    start = end + 1
+                    end = buf.find('\n', start)
+
+                if start:
+                    del buf[:start]
+        except Exception as e:
+            self.error = e
+            self.running = False
+
+    def stop(self):
+        self.running = False
+
+        if self is not threading.current_thread():
+            self.join()
+
+class _Info(object):
+    """ An attribute read from the device the first time it is asked
+    for, with the connection open, by the method named load.
+    """
+
+    def __init__(self, name, load):
+        self.name = name
+        self.load = load
+
+    def __get__(self, og, cls):
+        if og is None:
+            return(self)
+
+        if self.name not in og._info and og._connected:
+            with og.lock:
+                if self.name not in og._info:
+                    getattr(og, self.load)()
+
+        return(og._info.get(self.name))
+
+    def __set__(self, og, value):
+        if value is None:
+            og._info.pop(self.name, None)
+        else:
+            og._info[self.name] = value
+
+class _Cached(_Info):
+    """ A setup attribute of the device, kept in the OpenGarden cache.
+
+    It is read from the device the first time it is asked for, setting
+    it to a value different from the one known marks it dirty, so that
+    save() sends it.
+    """
+
+    def __init__(self, name, load, normalize=None):
+        _Info.__init__(self, name, load)
+        self.normalize = normalize
+
+    def __get__(self, og, cls):
+        if og is None:
+            return(self)
+
+        if self.name not in og._cache and og._connected:
+            with og.lock:
+                if self.name not in og._cache:
+                    getattr(og, self.load)()
+
+        return(og._value(self.name))
+
+    def __set__(self, og, value):
+        if value is not None and self.normalize is not None:
+            value = self.normalize(value)
+
+        entry = og._cache.get(self.name)
+
+        if value is None:
+            og._cache.pop(self.name, None)
+        elif entry is None or entry[0] != value:
+            og._cache[self.name] = [value, None, True]
+
+class OpenGarden(object):
     """ The basic class definition
 
     Some usefull docs.
@@ -46,70 +324,546 @@ class OpenGarden:
     del(og)
 
     Formats:
-    - self.programs = [(1530,30,0xff,1), (1600,45,0x10,2)]
+    - self.programs is a list of program.Program, strings in the
+      device format (HHMM,LLL,MM,L or NN,HHMM,LLL,MM,L, ex. the lines
+      of a file) assigned to it are decoded:
+        og.programs = ["1530,030,ff,0", "1600,045,10,1"]
     - self.sunsite is device phisical installation where:
         2 is shadowed site.
         1 half-sun site.
         0 full-sun site.
 
+    Echo check:
+    - every char sent is echoed back by the device. With blockmode set
+      (the default) the whole command is written at once and the echo
+      is checked with a single read, old firmware which cannot keep up
+      should set blockmode = False to fall back to one char at a time.
+      A mismatch raises ComError with the offset of the wrong byte.
+
+    Reader:
+    - with threaded set (the default, block mode only) a reader thread
+      frames what the device sends into lines and the commands take
+      their echo and reply from its queue. Lines received out of a
+      reply, before an echo or between two commands, are handed to
+      _unsolicited() instead of being parsed as the next reply.
+
+    Events:
+    - the device can print a log line for every event (valves opened
+      and closed, alarms). By default connect() turns the log off, with
+      log_events set (it needs the reader) it turns it on. The lines
+      received out of a reply are given to the subscribe()d callbacks
+      and to the events() iterators.
+    - the log lines can arrive in the middle of a reply: if the
+      firmware marks them, set log_prefix to the mark (None by
+      default) and the lines starting with it are taken out of the
+      replies as soon as they are received, without the mark.
+
+        og.log_events = True
+        og.log_prefix = "Log: "
+        og.connect('/dev/ttyUSB0')
+
+        for t, text in og.events():
+            print time.ctime(t), text
+
+    Threads:
+    - the serial port and the device attributes belong to the instance,
+      each OpenGarden object drives its own device and different
+      devices can be used from different threads at the same time.
+    - every method which talks to the device holds self.lock, a
+      reentrant lock, for the whole command/reply exchange. An object
+      can be shared among threads, but to read or change attributes
+      and then save() them consistently hold self.lock around the
+      whole sequence:
+
+        with og.lock:
+            og.sunsite = 2
+            og.save()
+
+    Lazy attributes:
+    - connect() only turns the device log on or off and reads the
+      version, to check the device. The serial, sunsite, valve, alarm,
+      led and programs are read from the device the first time they
+      are used. load() reads the setup ones in one batch.
+
+        og.connect('/dev/ttyUSB0')
+        print og.serial         # asks the device now.
+        print og.serial         # from memory.
+
+    Cache:
+    - sunsite, valve, alarm, led and programs are cached with the time
+      they were read from (or acknowledged by) the device. Setting one
+      of them to a new value marks it dirty and save() only sends the
+      dirty ones (the programs are always compared with the ones on
+      the device). load() and the rt_load_* methods do not ask the
+      device for values younger than cache_ttl seconds and not dirty.
+    - invalidate() drops the cache, ex. if someone else may have
+      changed the device setup. dirty() lists the attributes to save.
+
+    Timeouts:
+    - every command must be answered within timeout seconds, the echo
+      within echo_timeout (plus the time to transmit it) so that a dead
+      device is detected quickly. load(), save() and the batches have
+      op_timeout seconds for all their commands. Past a deadline
+      Timeout is raised, in a batch the commands left are aborted.
+    - self.latency is the Histogram of the commands latency.
+
     Known Bugs:
     - self.id name is too common, change it to something else.
     """
 
-    _s = serial.Serial()
-    _s.port = None
-    _s.baudrate = 9600
-    _s.bytesize = 8
-    _s.parity = 'N'
-    _s.stopbits = 1
-    _s.timeout = 10
-
-    version = None
-    serial = None
-    programs = None
-    sunsite = None
-    valve = None
-    alarm = None
-    led = None
+    blockmode = True
+    threaded = True
+    log_events = False
+    log_prefix = None
+    cache_ttl = 60
+    timeout = 10
+    echo_timeout = 1
+    op_timeout = 60
+
+    version = _Info("version", "_version")
+    serial = _Info("serial", "_serial")
+    sunsite = _Cached("sunsite", "rt_load_sunsite", str)
+    valve = _Cached("valve", "rt_load_valve")
+    alarm = _Cached("alarm", "rt_load_alarm_level")
+    led = _Cached("led", "rt_load_led_setup")
+    programs = _Cached("programs", "_load_programs", decodeList)
+
+    def __init__(self):
+        self._s = serial.Serial()
+        self._s.port = None
+        self._s.baudrate = 9600
+        self._s.bytesize = 8
+        self._s.parity = 'N'
+        self._s.stopbits = 1
+        self._s.timeout = 10
+
+        self.lock = threading.RLock()
+        self._connected = False
+        self._info = {}
+        self._cache = {}
+        self._device_programs = None
+        self.latency = Histogram()
+        self._cmd = None
+        self._deadline = None
+        self._op_deadline = None
+        self._reader = None
+        self._subscribers = []
+
+    def _store(self, name, value):
+        """ Cache a value read from the device.
+        """
+
+        self._cache[name] = [value, time.time(), False]
+        return(value)
+
+    def _value(self, name):
+        """ Return the cached value, None if not read, without asking
+        the device.
+        """
+
+        entry = self._cache.get(name)
+
+        if entry is None:
+            return(None)
+
+        return(entry[0])
+
+    def _fresh(self, name):
+        """ Tell if the cached value is clean and younger than cache_ttl.
+        """
+
+        entry = self._cache.get(name)
+
+        return(entry is not None and not entry[2] and \
+                time.time() - entry[1] < self.cache_ttl)
+
+    def _reply_saved(self, name, value):
+        """ Return the reply function of a command saving value, which
+        marks it clean once the device acknowledges it.
+        """
+
+        def reply():
+            self._get_ok()
+
+            if self._cache.get(name, [None])[0] == value:
+                self._store(name, value)
+
+        return(reply)
+
+    def dirty(self):
+        """ Return the list of the attributes changed and not yet saved.
+        """
+
+        return(sorted([i for i in self._cache if self._cache[i][2]]))
+
+    def invalidate(self, name=None):
+        """ Drop the cached value of the attribute name, or of all of them.
+
+        Changes not yet saved are lost.
+        """
+
+        if name is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(name, None)
 
     def _sendcmd(self, cmd):
-        """ Send the command to the serial port one char at a time.
+        """ Send the command to the serial port and check the echo.
 
         Keyword arguments:
         cmd -- the command string to send.
         """
 
-        self._s.flushInput()
+        self._begin(cmd)
+        self._flush()
+
+        if self.blockmode or self._reader is not None:
+            self._s.write(cmd + '\r')
+            self._check_echo(cmd)
+            return
+
+        echo = ''
 
         for i in cmd[:]:
             self._s.write(i)
-            j = self._s.read()
+            j = self._read()
+            echo += j
 
             if i != j:
-                raise NameError('ComError')
+                self._echo_error(cmd, echo)
 
         self._s.write('\r')
-        self._s.read() # Read the \n
-        self._s.read() # Read the \r
+        self._read(2) # Read the \n\r
+
+    def _exchange(self, cmd, reply=None):
+        """ Send the command and read the reply, recording the latency.
+
+        Keyword arguments:
+            cmd -- the command string to send.
+            reply -- the function which reads the reply, by default
+                the OK answer is expected.
+
+        Return:
+            the value returned by reply.
+        """
+
+        start = time.time()
+
+        try:
+            self._sendcmd(cmd)
+
+            if reply is None:
+                value = self._get_ok()
+            else:
+                value = reply()
+        except Timeout:
+            self.latency.add_timeout()
+            raise
+
+        self.latency.add(time.time() - start)
+        return(value)
+
+    def _begin(self, cmd):
+        """ Start the time budget of a command.
+        """
+
+        self._cmd = cmd
+        self._deadline = time.time() + self.timeout
+
+        if self._op_deadline is not None:
+            self._deadline = min(self._deadline, self._op_deadline)
+
+    def _left(self, stage, limit=None):
+        """ Return what is left of the command budget, at most limit.
+        """
+
+        left = self._deadline - time.time()
+
+        if limit is not None:
+            left = min(left, limit)
+
+        if left <= 0:
+            raise Timeout(self._cmd, stage)
+
+        return(left)
+
+    def _settimeout(self, stage, limit=None):
+        """ Set the port timeout to what is left of the command budget.
+        """
+
+        self._s.timeout = self._left(stage, limit)
+
+    def _echo_limit(self, size):
+        """ Seconds to wait for size echoed bytes. """
+
+        baudrate = getattr(self._s, 'baudrate', None)
+
+        if baudrate:
+            return(self.echo_timeout + size * 10.0 / baudrate)
+        else:
+            return(self.echo_timeout)
+
+    def _start_reader(self):
+        self._stop_reader()
+        self._reader = _Reader(self._s, self.lock, self.log_prefix,
+                self._unsolicited)
+        self._reader.start()
+
+    def _stop_reader(self):
+        reader, self._reader = self._reader, None
+
+        if reader is not None:
+            reader.stop()
+            self._s.timeout = self.timeout
+
+    def _nextline(self, stage, limit=None):
+        """ Get the next line from the reader within the deadline.
+        """
+
+        try:
+            return(self._reader.lines.get(True, self._left(stage, limit)))
+        except Queue.Empty:
+            if self._reader.error is not None:
+                raise NameError('NoConnect')
+
+            raise Timeout(self._cmd, stage)
+
+    def _flush(self):
+        """ Drop what the device sent and nobody asked for.
+        """
+
+        if self._reader is None:
+            self._s.flushInput()
+            return
+
+        while True:
+            try:
+                line = self._reader.lines.get_nowait()
+            except Queue.Empty:
+                return
+
+            self._unsolicited(line)
+
+    def _drain(self, quiet=0.1):
+        """ Drop what the device sends until it is quiet, to put the
+        line back in sync after an error.
+
+        Keyword arguments:
+            quiet -- seconds without data which end the drain, it never
+                lasts more than timeout.
+        """
+
+        limit = time.time() + self.timeout
+
+        if self._reader is not None:
+            while time.time() < limit:
+                try:
+                    line = self._reader.lines.get(True, quiet)
+                except Queue.Empty:
+                    return
+
+                self._unsolicited(line)
+
+            return
+
+        self._s.timeout = quiet
+
+        while time.time() < limit and self._s.read(256):
+            pass
+
+    def _unsolicited(self, line):
+        """ Called with the lines received out of a reply, the device
+        sent them on its own: they are log events.
+        """
+
+        if line.strip():
+            self._log_event(line)
+
+    def _log_event(self, line):
+        """ Hand a log line to the subscribers.
+        """
+
+        if self.log_prefix and line.startswith(self.log_prefix):
+            line = line[len(self.log_prefix):]
+
+        event = (time.time(), line.strip())
+
+        for callback in self._subscribers:
+            callback(*event)
+
+    def subscribe(self, callback):
+        """ Call callback(time, text) for every log line of the device.
+
+        The callback runs in the reader thread or in the one sending a
+        command, it must return quickly and must not send commands to
+        the device.
+
+        Return:
+            the callback, to unsubscribe() it.
+        """
+
+        self._subscribers = self._subscribers + [callback]
+        return(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers = [i for i in self._subscribers if i != callback]
+
+    def events(self, timeout=None):
+        """ Iterate on the (time, text) log lines of the device.
+
+        The events are collected from the call on, not from the first
+        iteration. The subscription ends with the iteration, or with
+        close() on the iterator.
+
+        Keyword arguments:
+            timeout -- stop after these seconds without events, wait
+                forever if None.
+        """
+
+        if timeout is None:
+            timeout = 1e9
+
+        lines = Queue.Queue()
+        callback = self.subscribe(lambda t, text: lines.put((t, text)))
+        return(self._events(lines, callback, timeout))
+
+    def _events(self, lines, callback, timeout):
+        try:
+            while True:
+                try:
+                    yield lines.get(True, timeout)
+                except Queue.Empty:
+                    return
+        finally:
+            self.unsubscribe(callback)
+
+    def _read(self, size=1):
+        """ Read echoed bytes, they must arrive within echo_timeout.
+        """
+
+        self._settimeout("echo", self._echo_limit(size))
+        data = self._s.read(size)
+
+        if len(data) < size:
+            raise Timeout(self._cmd, "echo")
+
+        return(data)
+
+    def _readline(self):
+        """ Read a line of the reply within the command deadline.
+        """
+
+        if self._reader is not None:
+            return(self._nextline("reply"))
+
+        self._settimeout("reply")
+        line = self._s.readline()
+
+        if not line.endswith('\n'):
+            raise Timeout(self._cmd, "reply")
+
+        return(line)
+
+    def _check_echo(self, cmd):
+        """ Read back the echo of a command already written in block mode.
+        """
+
+        if self._reader is not None:
+            limit = time.time() + self._echo_limit(len(cmd) + 2)
+            wrong = None
+
+            while True:
+                try:
+                    line = self._nextline("echo", limit - time.time())
+                except Timeout:
+                    # no echo, a line as long as the command was it.
+                    if wrong is not None:
+                        self._echo_error(cmd, wrong)
+
+                    raise
+
+                # the echo ends with \n\r, other lines may end with
+                # \r\n: compare the text only.
+                text = line.rstrip('\r\n')
+
+                if text.endswith(cmd):
+                    break
+                elif wrong is None and len(text) == len(cmd):
+                    wrong = text
+
+                # not the echo, something the device sent on its own.
+                self._unsolicited(line)
+
+            if len(text) > len(cmd):
+                self._unsolicited(text[:-len(cmd)])
+
+            return
+
+        echo = self._read(len(cmd) + 2)
+        echo = echo[:len(cmd)]
+
+        if echo != cmd:
+            self._echo_error(cmd, echo)
+
+    def _echo_error(self, cmd, echo):
+        offset = 0
+
+        while offset < min(len(echo), len(cmd)) and \
+                echo[offset] == cmd[offset]:
+            offset += 1
+
+        raise ComError(offset, cmd, echo)
 
     def _get_ok(self):
-        ok = self._s.readline()
+        ok = self._readline()
 
         if ok.strip() != "OK":
             raise NameError('NOOK')
 
+    def batch(self, depth=8, timeout=None):
+        """ Create a batch of commands to be pipelined to the device.
+
+        Keyword arguments:
+            depth -- max number of commands sent ahead of their reply.
+            timeout -- seconds for the whole batch, op_timeout if None.
+
+        Example:
+            with og.batch() as b:
+                b.add("y", og._read_sunsite)
+                b.add("A", og._read_alarm)
+
+            for cmd, value, error in b.results:
+                print cmd, value, error
+        """
+
+        return Batch(self, depth, timeout)
+
+    @_locked
     def _version(self):
         """ Get the version (git) of a device connected.
         """
 
-        self._sendcmd("v")
-        self.version = self._s.readline()
+        self._exchange("v", self._read_version)
 
-        if self.version[:10] == 'OpenGarden':
-            self.version = self.version[11:].strip()
-        else:
-            raise NameError('NoConnect')
+    def _read_field(self, prefix, error='BadReply'):
+        """ Read a "<prefix><value>" reply line.
 
+        Return:
+            the value, raise NameError(error) if the prefix is wrong.
+        """
+
+        line = self._readline()
+
+        if not line.startswith(prefix):
+            raise NameError(error)
+
+        return(line[len(prefix):].strip())
+
+    def _read_version(self):
+        self.version = self._read_field("OpenGarden ", 'NoConnect')
+        return(self.version)
+
+    @_locked
     def _serial(self):
         """ Read the serial number.
 
@@ -120,19 +874,27 @@ class OpenGarden:
             print OpenGarden.serial()
         """
 
-        self._sendcmd("S")
-        self.serial = self._s.readline()
-        self.serial = self.serial[8:].strip()
+        return(self._exchange("S", self._read_serial))
+
+    def _read_serial(self):
+        self.serial = self._read_field("Serial: ")
+        return(self.serial)
 
+    @_locked
     def rt_load_sunsite(self):
         """ Load the sunsite value from the device.
         """
 
-        self._sendcmd("y")
-        self.sunsite = self._s.readline()
-        self.sunsite = self.sunsite[0]
-        return(self.sunsite)
+        if self._fresh("sunsite"):
+            return(self.sunsite)
+
+        return(self._exchange("y", self._read_sunsite))
+
+    def _read_sunsite(self):
+        sunsite = self._readline()
+        return(self._store("sunsite", sunsite[0]))
 
+    @_locked
     def rt_save_sunsite(self, sunsite=None):
         """ Send the sunsite value to the device.
         """
@@ -140,21 +902,28 @@ class OpenGarden:
         if sunsite:
             self.sunsite=sunsite
 
-        self._sendcmd("y" + str(self.sunsite))
-        self._get_ok()
+        self._exchange(self._cmd_sunsite(),
+                self._reply_saved("sunsite", self.sunsite))
+
+    def _cmd_sunsite(self):
+        return("y" + str(self.sunsite))
 
+    @_locked
     def rt_load_valve(self):
         """ Load the valve type from the device.
         """
-        self._sendcmd("V")
+        if self._fresh("valve"):
+            return(self.valve)
 
-        if (self._s.readline().find("1")) != -1:
-            self.valve = 'monostable'
-        else:
-            self.valve = 'bistable'
+        return(self._exchange("V", self._read_valve))
 
-        return(self.valve)
+    def _read_valve(self):
+        if (self._readline().find("1")) != -1:
+            return(self._store("valve", 'monostable'))
+        else:
+            return(self._store("valve", 'bistable'))
 
+    @_locked
     def rt_save_valve(self, valve=None):
         """ Set the valve type into the RAM of the device.
         """
@@ -162,31 +931,47 @@ class OpenGarden:
         if valve:
             self.valve = valve
 
+        self._exchange(self._cmd_valve(),
+                self._reply_saved("valve", self.valve))
+
+    def _cmd_valve(self):
         if self.valve == 'monostable':
-            self._sendcmd("V1")
+            return("V1")
         else:
-            self._sendcmd("V2")
-
-        self._get_ok()
+            return("V2")
 
+    @_locked
     def _log_disable(self):
         """ Disable log event.
 
         This is necessary to avoid conflict when sending commands.
         """
 
-        self._sendcmd("L0")
-        self._get_ok()
+        self._exchange("L0")
+
+    @_locked
+    def _log_enable(self):
+        """ Enable log event, the log lines are taken out of the replies
+        by the reader.
+        """
+
+        self._exchange("L1")
 
+    @_locked
     def rt_load_alarm_level(self):
         """ Load from the device the level (high, low) which triggers
         the alarm.
         """
 
-        self._sendcmd("a")
-        self.alarm = self._s.readline().strip()
-        return(self.alarm)
+        if self._fresh("alarm"):
+            return(self.alarm)
+
+        return(self._exchange("a", self._read_alarm_level))
 
+    def _read_alarm_level(self):
+        return(self._store("alarm", self._readline().strip()))
+
+    @_locked
     def rt_save_alarm_level(self, alarm=None):
         """ Store the alarm level to the device.
         """
@@ -194,21 +979,29 @@ class OpenGarden:
         if alarm:
             self.alarm = alarm
 
+        self._exchange(self._cmd_alarm_level(),
+                self._reply_saved("alarm", self.alarm))
+
+    def _cmd_alarm_level(self):
         if self.alarm == "HIGH":
-            self._sendcmd("aH")
+            return("aH")
         else:
-            self._sendcmd("aL")
-
-        self._get_ok()
+            return("aL")
 
+    @_locked
     def rt_load_led_setup(self):
         """ Load led's enable/disable (ON/OFF).
         """
 
-        self._sendcmd("e")
-        self.led = self._s.readline().strip()
-        return(self.led)
+        if self._fresh("led"):
+            return(self.led)
+
+        return(self._exchange("e", self._read_led_setup))
 
+    def _read_led_setup(self):
+        return(self._store("led", self._readline().strip()))
+
+    @_locked
     def rt_save_led_setup(self, led=None):
         """ Send the led setup attribute self.led to the device.
 
@@ -222,72 +1015,191 @@ class OpenGarden:
         if led:
             self.led = led
 
+        self._exchange(self._cmd_led_setup(),
+                self._reply_saved("led", self.led))
+
+    def _cmd_led_setup(self):
         if self.led == "ON":
-            self._sendcmd("e1")
+            return("e1")
         else:
-            self._sendcmd("e0")
-
-        self._get_ok()
+            return("e0")
 
+    @_locked
     def _send_eepromload_cmd(self):
         """ Restore the EEPROM memory to RAM of the device.
         """
 
-        self._sendcmd("r")
-        self._get_ok()
+        self._device_programs = None
+        self._exchange("r")
 
+    @_locked
     def _load_programs(self):
         """ Read the programs in RAM from the device. """
 
-        self._sendcmd("l")
-        ans = self._s.readline()
+        if self._fresh("programs"):
+            return(self.programs)
+
+        return(self._exchange("l", self._read_programs))
+
+    def _read_programs(self):
+        ans = self._readline()
 
-        if ans[:10] != "Programs [":
+        if not ans.startswith("Programs [") or ans[12:13] != "]":
             raise NameError('ErrProgNo')
 
         nprog = int(ans[10:12])
-        self.programs = []
+        programs = []
 
         for i in range(nprog):
-            ans = self._s.readline().strip()
-            self.programs.append(ans)
+            programs.append(decode(self._readline()))
 
-    def _save_programs(self):
-        """ Store the programs in the device's RAM """
+        self._device_programs = list(programs)
+        return(self._store("programs", programs))
 
-        # Clear RAM
-        self._sendcmd('C')
+    @_locked
+    def _save_programs(self, full=False):
+        """ Store the programs in the device's RAM
+
+        Only programs appended to the end of the list are sent alone,
+        editing, deleting or reordering any other program clears the
+        RAM and sends them all again (see _queue_programs()).
+
+        Keyword arguments:
+            full -- clear the RAM and send all the programs even if
+                some of them are already on the device.
+        """
+
+        b = self.batch()
+        self._queue_programs(b, full)
+        b.run()
+        self._check_programs(b.results)
+        b.check()
+
+    def _queue_programs(self, b, full=False):
+        """ Add to the batch b the commands to store the programs.
+
+        Only the changes against the programs known to be on the device
+        (read or stored by this object) are sent. The firmware can only
+        clear the RAM or append a program, so if the programs on the
+        device are the first ones of the list the others are appended,
+        when they are all there nothing is sent. In any other case the
+        RAM is cleared and all the programs are sent.
+
+        More than MAX_PROGRAMS programs raise ValueError, nothing is
+        queued.
+
+        The sync is append only: with 50 programs on the device, adding
+        a 51st sends one command, while changing or removing the 2nd
+        one sends C and all the programs left.
+        """
+
+        self._check_capacity()
+        target = list(self._value("programs"))
+        known = self._device_programs
+
+        if not full and known is not None and target[:len(known)] == known:
+            target = target[len(known):]
+        else:
+            b.add('C', self._reply_clear)
+
+        for i in target:
+            b.add('p' + encode(i), self._reply_program(i))
+
+    def _check_capacity(self):
+        """ Raise ValueError if the programs do not fit the device.
+        """
+
+        n = len(self._value("programs"))
+
+        if n > MAX_PROGRAMS:
+            raise ValueError("%d programs, the device stores %d" % \
+                    (n, MAX_PROGRAMS))
+
+    def _reply_clear(self):
         self._get_ok()
+        self._device_programs = []
+
+    def _reply_program(self, program):
+        # the firmware does not answer a program, the echo is all.
+        def reply():
+            if self._device_programs is not None:
+                self._device_programs.append(program)
+
+        return(reply)
+
+    def _check_programs(self, results):
+        """ Forget the programs on the device if any command storing
+        them failed, the next save will rewrite them all, otherwise
+        mark the programs clean.
+        """
 
-        for i in self.programs:
-            self._sendcmd('p' + i[3:].strip())
+        for cmd, value, error in results:
+            if error is not None and cmd[0] in "Cp":
+                self._device_programs = None
+                self._cache["programs"][2] = True
+                return
 
+        if self._value("programs") is not None:
+            self._store("programs", self._value("programs"))
+
+    @_locked
     def _send_eepromsave_cmd(self):
         """ Write the RAM contents to EEPROM of the device.
         """
 
-        self._sendcmd("s")
-        self._get_ok()
+        self._exchange("s")
 
+    @_locked
     def connect(self, device):
-        """ Connect to the device and set the device version and serial.
+        """ Connect to the device, set its log on or off and read its
+        version, which checks that the port is an OpenGarden.
+
+        The other attributes are read from the device when first used,
+        the cache and the changes not saved of a previous connection
+        are dropped.
+
+        Keyword arguments:
+            device -- the serial port name, or an object already open
+                which behaves like a serial port (ex. the
+                simulator.LoopbackSerial).
         """
 
         if device is None:
             raise "A device MUST be given!"
 
-        self._s.port = device
-        self._s.open()
-        self._log_disable()
+        self._device_programs = None
+        self._info.clear()
+        self.invalidate()
+        self._connected = False
+        self._stop_reader()
+
+        if isinstance(device, basestring):
+            self._s.port = device
+            self._s.open()
+        else:
+            self._s = device
+
+        if self.threaded and self.blockmode:
+            self._start_reader()
+
+        if self.log_events and self._reader is not None:
+            self._log_enable()
+        else:
+            self._log_disable()
+
+        # raise NoConnect now if the device is not an OpenGarden.
         self._version()
-        self._serial()
-        self.rt_load_sunsite()
+        self._connected = True
 
+    @_locked
     def disconnect(self):
         """ Close the connection.
         """
+        self._connected = False
+        self._stop_reader()
         self._s.close()
 
+    @_locked
     def time(self, t=None):
         """ Get or set the time of the device.
 
@@ -304,30 +1216,69 @@ class OpenGarden:
         else:
             cmd = "d" + str(t)
 
-        self._sendcmd(cmd)
-        idt = self._s.readline()
+        return(self._exchange(cmd, self._read_time))
+
+    def _read_time(self):
+        idt = self._readline()
         return(idt.strip())
 
+    @_locked
     def load(self):
         """ loads programs and sunsite attributes from the device.
+
+        The attributes already in the cache and fresh are not read
+        again, the commands are pipelined in a single batch.
         """
 
-        self.rt_load_sunsite()
-        self.rt_load_valve()
-        self._load_programs()
-        self.rt_load_alarm_level()
-        self.rt_load_led_setup()
+        b = self.batch()
+
+        for cmd, name, reply in (("y", "sunsite", self._read_sunsite),
+                ("V", "valve", self._read_valve),
+                ("l", "programs", self._read_programs),
+                ("a", "alarm", self._read_alarm_level),
+                ("e", "led", self._read_led_setup)):
+            if not self._fresh(name):
+                b.add(cmd, reply)
+
+        b.run()
+        b.check()
 
-    def save(self):
+    @_locked
+    def save(self, progress=None):
         """ save programs and sunsite attributes to the device.
+
+        Only the attributes changed are sent, the commands are
+        pipelined in a single batch.
+
+        Keyword arguments:
+            progress -- function called with (done, total) commands
+                after each reply, ex. to show how a long upload goes.
+        """
+
+        b = self.batch()
+        b.progress = progress
+        self._queue_saved(b, "led", self._cmd_led_setup)
+        self._queue_saved(b, "alarm", self._cmd_alarm_level)
+
+        if self._value("programs") is not None:
+            self._queue_programs(b)
+
+        self._queue_saved(b, "valve", self._cmd_valve)
+        self._queue_saved(b, "sunsite", self._cmd_sunsite)
+        b.run()
+        self._check_programs(b.results)
+        b.check()
+
+    def _queue_saved(self, b, name, cmd):
+        """ Add to the batch b the command to save name, if dirty.
         """
 
-        self.rt_save_led_setup()
-        self.rt_save_alarm_level()
-        self._save_programs()
-        self.rt_save_valve()
-        self.rt_save_sunsite()
+        entry = self._cache.get(name)
+
+        if entry is not None and entry[2]:
+            b.add(cmd(), self._reply_saved(name, entry[0]))
 
+    @_locked
     def temperature(self):
         """ Read the temperature from the device's thermometer.
 
@@ -338,11 +1289,12 @@ class OpenGarden:
             print og.temperature()
         """
 
-        self._sendcmd("g")
-        temp = self._s.readline()
-        temp = temp[12:].strip().split(',')
-        return(temp)
+        return(self._exchange("g", self._read_temperature))
 
+    def _read_temperature(self):
+        return(self._read_field("Temperature ").split(','))
+
+    @_locked
     def get_alarm(self):
         """ Read the alarm's lines status.
 
@@ -350,10 +1302,146 @@ class OpenGarden:
             ON/OFF
         """
 
-        self._sendcmd("A")
-        alrm = self._s.readline()
+        return(self._exchange("A", self._read_alarm))
+
+    def _read_alarm(self):
+        alrm = self._readline()
         return(alrm.strip())
 
+class Batch:
+    """ Commands pipelined to the device.
+
+    The commands are written back to back, up to depth commands ahead
+    of the one whose reply is being parsed, so the latency of each
+    exchange overlaps with the others. Replies are parsed in order.
+
+    After run(), self.results is a list of (cmd, value, error) for
+    each command. A NOOK is a whole reply line, the line is still in
+    sync: it is stored in its own entry and the batch goes on. Any
+    other error (a wrong echo, a timeout, a reply failing in the
+    middle of its lines) leaves the line out of sync, so the batch
+    stops, the error is reported to the failed command and to all the
+    commands left, then what the device still sends is drained.
+
+    Without og.blockmode the commands are sent one by one.
+
+    If self.progress is set it is called with (done, total) after each
+    reply, from the thread running the batch.
+    """
+
+    def __init__(self, og, depth=8, timeout=None):
+        self._og = og
+        self._queue = []
+        self.depth = depth
+        self.timeout = timeout
+        self.results = None
+        self.progress = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.run()
+
+    def add(self, cmd, reply=None):
+        """ Queue a command.
+
+        Keyword arguments:
+            cmd -- the command string to send.
+            reply -- the function which reads the reply, by default
+                the OK answer is expected.
+        """
+
+        if reply is None:
+            reply = self._og._get_ok
+
+        self._queue.append((cmd, reply))
+
+    def run(self):
+        """ Send the queued commands and read the replies.
+
+        Return:
+            the list of (cmd, value, error).
+        """
+
+        with self._og.lock:
+            return(self._run())
+
+    def _run(self):
+        og = self._og
+        queue = self._queue
+        self._queue = []
+        self.results = []
+        written = []
+
+        if self.timeout is None:
+            og._op_deadline = time.time() + og.op_timeout
+        else:
+            og._op_deadline = time.time() + self.timeout
+
+        if og.blockmode:
+            og._flush()
+
+        try:
+            for i, (cmd, reply) in enumerate(queue):
+                try:
+                    if og.blockmode:
+                        while len(written) < min(len(queue), i + self.depth):
+                            og._s.write(queue[len(written)][0] + '\r')
+                            written.append(time.time())
+
+                        og._begin(cmd)
+                        og._check_echo(cmd)
+                    else:
+                        written.append(time.time())
+                        og._sendcmd(cmd)
+
+                    value = reply()
+                except NameError as e:
+                    if e.args != ('NOOK',):
+                        self._abort(queue[i:], e)
+                        break
+
+                    self.results.append((cmd, None, e))
+                except (ValueError, IndexError) as e:
+                    self._abort(queue[i:], e)
+                    break
+                else:
+                    self.results.append((cmd, value, None))
+
+                og.latency.add(time.time() - written[i])
+
+                if self.progress is not None:
+                    self.progress(len(self.results), len(queue))
+        finally:
+            og._op_deadline = None
+
+        return(self.results)
+
+    def _abort(self, queue, e):
+        """ Fail the commands left with e and put the line back in sync.
+        """
+
+        og = self._og
+
+        # ComError and Timeout are NameError too.
+        if isinstance(e, Timeout):
+            og.latency.add_timeout()
+
+        for cmd, reply in queue:
+            self.results.append((cmd, None, e))
+
+        og._drain()
+
+    def check(self):
+        """ Raise the first error found in the results, if any.
+        """
+
+        for cmd, value, error in self.results:
+            if error is not None:
+                raise error
+
 if __name__ == "__main__":
     print "This is a module"
 
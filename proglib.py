@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden program library
+
+Keep the program sets in a directory, each one stored once under the
+hash of its content, so the programs of a device are matched against
+the library by hashing them.
+
+The order of the programs on the device does not change what they do,
+so a set is normalized (sorted) before hashing: the same programs in
+any order have the same hash.
+
+    <hash>.csv  the programs, as written by --get-programs.
+    names       "<name> <hash>" lines, the names given to the sets.
+
+Example:
+
+lib = Library('/var/lib/opengarden/programs')
+summer = lib.add(decodeList(open('summer.csv')), 'summer')
+
+if lib.match(og._load_programs()) != summer:
+    print og.serial, "is not on the summer schedule"
+"""
+
+import os
+import hashlib
+from program import encode, encodeList, decodeList
+
+def normalize(programs):
+    """ Return the programs sorted, the order they run in does not
+    depend on their index.
+    """
+
+    return(sorted(decodeList(programs), key=lambda p: (p.start, p.line, \
+            p.days, p.length)))
+
+def digest(programs):
+    """ Return the hash (hex sha1) of a list of programs. """
+
+    text = "".join([encode(p) + "\n" for p in normalize(programs)])
+    return(hashlib.sha1(text).hexdigest())
+
+class Library:
+    """ A directory of program sets, by hash and by name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._names = {}
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        names = os.path.join(path, "names")
+
+        if os.path.exists(names):
+            f = open(names)
+
+            for line in f:
+                fields = line.split()
+
+                if len(fields) == 2:
+                    self._names[fields[0]] = fields[1]
+
+            f.close()
+
+    def _file(self, key):
+        return(os.path.join(self.path, key + ".csv"))
+
+    def __contains__(self, key):
+        return(os.path.exists(self._file(key)))
+
+    def hashes(self):
+        """ Return the hashes of the sets in the library. """
+
+        return(sorted([i[:-4] for i in os.listdir(self.path) \
+                if i.endswith(".csv")]))
+
+    def names(self):
+        """ Return a dictionary name: hash of the named sets. """
+
+        return(dict(self._names))
+
+    def name(self, key):
+        """ Return the names of a set, by hash. """
+
+        return(sorted([n for n, h in self._names.items() if h == key]))
+
+    def resolve(self, key):
+        """ Return the hash of a set given its name, hash or the start
+        of its hash.
+
+        Raise NameError('NoProgramSet') if there is not one and only
+        one such set.
+        """
+
+        if key in self._names:
+            return(self._names[key])
+
+        found = [h for h in self.hashes() if h.startswith(key)]
+
+        if len(found) != 1:
+            raise NameError('NoProgramSet', key)
+
+        return(found[0])
+
+    def add(self, programs, name=None):
+        """ Store a set of programs, if not there already.
+
+        Keyword arguments:
+            programs -- list of Program or wire format strings.
+            name -- give this name to the set, moving the name from
+                the set it had.
+
+        Return:
+            the hash of the set.
+        """
+
+        programs = normalize(programs)
+        key = digest(programs)
+
+        if key not in self:
+            self._write(self._file(key), \
+                    "".join([i + "\n" for i in encodeList(programs)]))
+
+        if name is not None and self._names.get(name) != key:
+            if len(name.split()) != 1:
+                raise ValueError(name)
+
+            self._names[name] = key
+            self._write(os.path.join(self.path, "names"), \
+                    "".join(["%s %s\n" % i for i in sorted( \
+                    self._names.items())]))
+
+        return(key)
+
+    def _write(self, name, data):
+        # never leave a half written file, the rename is atomic.
+        tmp = name + ".tmp"
+        f = open(tmp, "w")
+
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        os.rename(tmp, name)
+
+    def get(self, key):
+        """ Return the programs of a set, by name or hash. """
+
+        f = open(self._file(self.resolve(key)))
+
+        try:
+            return(decodeList(f))
+        finally:
+            f.close()
+
+    def match(self, programs):
+        """ Return the hash of the set equal to programs, None if it is
+        not in the library.
+        """
+
+        key = digest(programs)
+
+        if key in self:
+            return(key)
+
+        return(None)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='OpenGarden program library.')
+    parser.add_argument('--library', required=True, metavar="<directory>", \
+            help="the program library directory.")
+    parser.add_argument('--add', type=argparse.FileType('r'), \
+            metavar="<filename>", help="store the programs of the file.")
+    parser.add_argument('--name', help="the name of the programs added.")
+    parser.add_argument('--show', metavar="<name|hash>", \
+            help="print the programs of a set.")
+    args = parser.parse_args()
+
+    lib = Library(args.library)
+
+    if args.add:
+        print lib.add(args.add.readlines(), args.name)
+        args.add.close()
+    elif args.show:
+        for i in encodeList(lib.get(args.show)):
+            print i
+    else:
+        for key in lib.hashes():
+            print key, " ".join(lib.name(key))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
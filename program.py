@@ -14,133 +14,212 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-""" OpenGarden GUI Progam module.
+""" OpenGarden Progam module.
 
-This is a support module for the python OpenGarden GUI.
+The programs of the appliance and their codec, shared by the
+python OpenGarden API, CLI and GUI.
 This module is part of the OpenGarden project.
 """
 
-class program:
+# Programs the appliance can store.
+MAX_PROGRAMS = 19
+
+# Days of the week, in the order of the bits of the day mask.
+DAY_NAMES = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+
+# Lookup tables of the codec:
+#	_DAYS[mask] are the indexes of the days set in the mask.
+#	_HEX[mask] and _UNHEX[text] convert the mask from and to the wire,
+#	_UNHEX also reads the " f" older GUI versions wrote below 0x10.
+#	_HHMM[minute] is the start time on the wire.
+_DAYS = [tuple([d for d in range(7) if m & 1 << d]) for m in range(256)]
+_HEX = ["%02x" % m for m in range(256)]
+_UNHEX = dict([("%02x" % m, m) for m in range(256)] + \
+		[("%02X" % m, m) for m in range(256)] + \
+		[("%2x" % m, m) for m in range(16)])
+_HHMM = ["%02d%02d" % divmod(m, 60) for m in range(1440)]
+
+class Program(object):
 	"""
-	This class implements a program the way it is used by OpenGarden GUI
-	and OpenGarden appliance.
+	A program of the OpenGarden appliance.
+
+	Programs are immutable, build a new one to change it:
+		start	-- start time, in minutes from midnight (0..1439).
+		length	-- length in minutes (1..999).
+		days	-- day mask, bit 0 is sunday (see DAY_NAMES).
+		line	-- output line (0..7), shown as 1..8 by the GUI.
+
+	Example: Program(17 * 60 + 30, 2, 0xff, 0)
 	"""
 
-	_start	= "0000"	#Start time: the first two digits represent the hour
-						#and the second two digits the minutes. The default
-						#is midnight
-	
-	_length	= 0			#Lenght of the program in minutes (one minute by
-						#default)
+	__slots__ = ('start', 'length', 'days', 'line')
 
-	_line	= 0			#Line which this program will work on.
+	def __init__(self, start, length, days, line):
+		if not (0 <= start < 1440 and 0 < length <= 999 and \
+				0 <= days <= 255 and 0 <= line <= 7):
+			raise ValueError((start, length, days, line))
 
-	_days	= ()		#Days on which the program will run.
+		set = object.__setattr__
+		set(self, 'start', start)
+		set(self, 'length', length)
+		set(self, 'days', days)
+		set(self, 'line', line)
 
-	def __init__(self):
-		"""
-		Default program initialization.
+	def __setattr__(self, name, value):
+		raise AttributeError("Program is immutable")
 
-		Example: program = program()
+	def __delattr__(self, name):
+		raise AttributeError("Program is immutable")
 
-		Create a meaningless program with default values, which are:
-		start: 00:00
-		length: 0 minutes
-		line: 0
-		days: none
-		"""
-		pass
+	def _key(self):
+		return (self.start, self.length, self.days, self.line)
 
-	def startTime(self,time=None):
-		"""
-		Read or set program's start time.
+	def __eq__(self, other):
+		return isinstance(other, Program) and self._key() == other._key()
 
-		Examples:
-			program.startTime()
-			program.startTime('0130')
-		"""
-		if time:
-			self._start = time
-		else:
-			return self._start
+	def __ne__(self, other):
+		return not self == other
 
-	def length(self,minutes=None):
-		"""
-		Read or set program's length in minutes.
+	def __hash__(self):
+		return hash(self._key())
 
-		Examples:
-			program.length()
-			program.length(60)
-		"""
-		if minutes:
-			self._length = minutes
-		else:
-			return self._length
+	def __reduce__(self):
+		return (Program, self._key())
 
-	def line(self,line=None):
-		"""
-		Read or set the line on which the program will run.
-		Line number is an integer.
+	def __repr__(self):
+		return "Program(%d, %d, 0x%02x, %d)" % self._key()
 
-		Examples:
-			program.line()
-			program.line(3)
-		"""
-		if line:
-			self._line = line
-		else:
-			return self._line
+	def __str__(self):
+		return encode(self)
 
-	def days(self,days=None):
+	def startTime(self):
+		"""
+		Return the start time as 'HH:MM'.
 		"""
-		Read or set the days on which the program will run.
-		Days is an list.
+		return "%02d:%02d" % divmod(self.start, 60)
 
-		Examples:
-			program.line()
-			program.line(('mon','thu'))
+	def weekdays(self):
 		"""
-		if days:
-			self._days = days
-		else:
-			return self._days
+		Return the indexes (0 is sunday) of the days the program runs.
+		"""
+		return _DAYS[self.days]
 
-	def asString(self):
+	def replace(self, **fields):
 		"""
-		Prints program's data as a formatted string.
+		Return a copy of the program with some fields changed.
 
-		Examples:
-			program.asString()
+		Example: p.replace(length=p.length * 2)
 		"""
-		string = _("%s (%3s) - line %s ") % (self._start, self._length, self._line)
-		string += "[ "
-		for day in self._days:
-			string += "%s " % (day)
-		string += "]"
-		return string
+		key = dict(zip(self.__slots__, self._key()))
+		key.update(fields)
+		return Program(key['start'], key['length'], key['days'], key['line'])
 
+def dayMask(weekdays):
+	"""
+	Return the day mask of a list of day indexes (0 is sunday).
+	"""
+	mask = 0
+	for d in weekdays:
+		mask |= 1 << d
+	return mask
 
-if __name__ == '__main__':
-	
-	print "Testing program class."
+def decode(text):
+	"""
+	Decode a program from the wire format HHMM,LLL,MM,L, with or
+	without the NN, index in front as listed by the appliance.
 
-	program = program()
+	Raise ValueError if the text is not a program.
+	"""
+	text = text.strip()
+
+	if len(text) == 16:
+		text = text[3:]
+
+	if len(text) != 13 or text[4] != ',' or text[8] != ',' or \
+			text[11] != ',':
+		raise ValueError(text)
+
+	try:
+		days = _UNHEX[text[9:11]]
+	except KeyError:
+		raise ValueError(text)
+
+	hour = int(text[:2])
+	minute = int(text[2:4])
+
+	if hour > 23 or minute > 59:
+		raise ValueError(text)
+
+	return Program(hour * 60 + minute, int(text[5:8]), days, int(text[12]))
+
+def encode(program, index=None):
+	"""
+	Encode a program in the wire format HHMM,LLL,MM,L, or
+	NN,HHMM,LLL,MM,L with the index given.
+	"""
+	text = "%s,%03d,%s,%d" % (_HHMM[program.start], program.length, \
+			_HEX[program.days], program.line)
 
-	print "===> Setting start time to 01:30"
-	program.startTime('0130')
-	print 'OK' if program.startTime() == '0130' else 'FAILED!!!'
+	if index is None:
+		return text
+	else:
+		return "%02d,%s" % (index, text)
 
-	print "===> Setting length to 01:00"
-	program.length(60)
-	print 'OK' if program.length() == 60 else 'FAILED!!!'
+def decodeList(programs):
+	"""
+	Return a list of Program from a list of programs and wire format
+	strings (ex. the lines of a file), skipping the empty lines.
+	"""
+	result = []
 
-	print "===> Setting line to 3"
-	program.line(3)
-	print 'OK' if program.line() == 3 else 'FAILED!!!'
+	for p in programs:
+		if not isinstance(p, Program):
+			if not p.strip():
+				continue
+			p = decode(p)
+		result.append(p)
 
-	print "===> Setting day to mon and thu"
-	program.days(('mon','thu'))
-	print 'OK' if program.days() == ('mon','thu') else 'FAILED!!!'
+	return result
 
-	print "===> Printing data as string:"
-	print program.asString()
+def encodeList(programs):
+	"""
+	Return the programs in the NN,HHMM,LLL,MM,L format, numbered
+	from 00.
+	"""
+	return [encode(p, i) for i, p in enumerate(programs)]
+
+
+if __name__ == '__main__':
+	
+	print "Testing Program class."
+
+	program = Program(90, 60, dayMask((1, 4)), 2)
+
+	print "===> Start time is 01:30"
+	print 'OK' if program.startTime() == '01:30' else 'FAILED!!!'
+
+	print "===> Days are mon and thu"
+	print 'OK' if [DAY_NAMES[d] for d in program.weekdays()] == \
+			['mon', 'thu'] else 'FAILED!!!'
+
+	print "===> Encoding"
+	print 'OK' if encode(program, 3) == '03,0130,060,12,2' else 'FAILED!!!'
+
+	print "===> Decoding"
+	print 'OK' if decode('03,0130,060,12,2\n') == program else 'FAILED!!!'
+
+	print "===> Program is immutable"
+	try:
+		program.line = 3
+		print 'FAILED!!!'
+	except AttributeError:
+		print 'OK'
+
+	print "===> Wrong programs are refused"
+	for text in ('2430,060,12,2', '0130,000,12,2', '0130,060,1x,2', \
+			'0130,060,12,8', '130,060,12,2'):
+		try:
+			decode(text)
+			print 'FAILED!!!', text
+		except ValueError:
+			print 'OK'
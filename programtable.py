@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden program table
+
+A list of programs stored by columns in NumPy arrays, to check and
+change many programs (of many devices) at once. It needs NumPy, the
+rest of the API does not.
+
+Example:
+
+t = ProgramTable.from_wire(open('programs.csv').read())
+t.scale(0.8)                # every program 20% shorter.
+t.shift(30, line=3)         # line 3 (on the wire) 30 minutes later.
+t.validate(MAX_PROGRAMS)
+og.programs = t.to_programs()
+"""
+
+import numpy as np
+from program import Program, MAX_PROGRAMS
+
+# The wire format, one program per line:
+#   NN,HHMM,LLL,MM,L
+#   0123456789012345
+_COMMAS = (2, 7, 11, 14)
+_WIDTH = 16
+
+# _UNHEX[c] is the value of the hex digit c, 255 if not a digit.
+_UNHEX = np.array([int(chr(c), 16) if chr(c) in "0123456789abcdefABCDEF" \
+        else 255 for c in range(256)], dtype=np.uint8)
+_HEX = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+# _ROTATE[n][mask] moves the days of the mask n days later, bit 7 is
+# not a day and stays where it is.
+_ROTATE = np.array([[(m & 0x80) | ((((m & 0x7f) << n) | \
+        ((m & 0x7f) >> (7 - n))) & 0x7f) for m in range(256)] \
+        for n in range(7)], dtype=np.uint8)
+
+class ProgramTable:
+    """ Programs as columns: start (minutes from midnight), length,
+    days (the mask) and line, as in program.Program.
+
+    The columns are NumPy arrays and can be read and changed in
+    place, validate() checks them all at once.
+    """
+
+    def __init__(self, start=(), length=(), days=(), line=()):
+        self.start = np.array(start, dtype=np.int32)
+        self.length = np.array(length, dtype=np.int32)
+        self.days = np.array(days, dtype=np.uint8)
+        self.line = np.array(line, dtype=np.uint8)
+
+    def __len__(self):
+        return(len(self.start))
+
+    def __getitem__(self, i):
+        return(Program(int(self.start[i]), int(self.length[i]), \
+                int(self.days[i]), int(self.line[i])))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @classmethod
+    def from_programs(cls, programs):
+        """ Build the table of a list of Program. """
+
+        return(cls([p.start for p in programs], [p.length for p in programs],
+                [p.days for p in programs], [p.line for p in programs]))
+
+    def to_programs(self):
+        """ Return the list of Program. """
+
+        return(list(self))
+
+    @classmethod
+    def concat(cls, tables):
+        """ Join the tables of many devices in one, to change them all
+        at once.
+
+        Return:
+            the table and the sizes of the tables, for split().
+        """
+
+        tables = list(tables)
+        t = cls()
+
+        for name in ("start", "length", "days", "line"):
+            column = [getattr(i, name) for i in tables]
+
+            if column:
+                setattr(t, name, np.concatenate(column))
+
+        return(t, [len(i) for i in tables])
+
+    def split(self, sizes):
+        """ Split a table made by concat() back into the device tables.
+        """
+
+        cuts = np.cumsum(sizes)[:-1]
+        columns = [np.split(getattr(self, name), cuts) \
+                for name in ("start", "length", "days", "line")]
+        return([ProgramTable(*i) for i in zip(*columns)])
+
+    @classmethod
+    def from_wire(cls, data):
+        """ Parse programs in the NN,HHMM,LLL,MM,L format, one per line
+        ended by \\n or \\r\\n, as listed by the device or stored in a
+        file. The text is read in place as a matrix of bytes.
+
+        Raise ValueError if a line is not a program.
+        """
+
+        nl = data.find(b"\n")
+
+        if nl < 0:
+            return(cls())
+
+        width = nl + 1
+
+        if data[nl - 1:nl] == b"\r":
+            end = b"\r\n"
+        else:
+            end = b"\n"
+
+        # the last line may lack its end.
+        if not data.endswith(b"\n"):
+            data = data.rstrip(b"\r") + end
+
+        if width - len(end) != _WIDTH or len(data) % width:
+            raise ValueError("not NN,HHMM,LLL,MM,L lines")
+
+        b = np.frombuffer(data, dtype=np.uint8).reshape(-1, width)
+        d = b.astype(np.int32) - ord("0")
+        hi = _UNHEX[b[:, 12]]
+        lo = _UNHEX[b[:, 13]]
+        digits = d[:, [0, 1, 3, 4, 5, 6, 8, 9, 10, 15]]
+        bad = (digits > 9).any(1) | (digits < 0).any(1) | \
+                (b[:, _COMMAS] != ord(",")).any(1) | (hi > 15) | (lo > 15) | \
+                (d[:, 3] * 10 + d[:, 4] > 23) | (d[:, 5] * 10 + d[:, 6] > 59)
+        days = hi << 4 | lo
+
+        if bad.any():
+            raise ValueError("bad program at line %d" % bad.argmax())
+
+        return(cls((d[:, 3] * 10 + d[:, 4]) * 60 + d[:, 5] * 10 + d[:, 6],
+                d[:, 8] * 100 + d[:, 9] * 10 + d[:, 10], days, d[:, 15]))
+
+    def to_wire(self):
+        """ Return the programs in the NN,HHMM,LLL,MM,L format, one per
+        line, numbered from 00.
+
+        Like program.encode() the index has two digits, more than 100
+        programs raise ValueError.
+        """
+
+        n = len(self)
+
+        if n > 100:
+            raise ValueError("%d programs, the index has two digits" % n)
+        b = np.empty((n, _WIDTH + 1), dtype=np.uint8)
+        b[:, _COMMAS] = ord(",")
+        b[:, _WIDTH] = ord("\n")
+        i = np.arange(n)
+        hour, minute = np.divmod(self.start, 60)
+
+        for col, value in ((0, i // 10), (1, i % 10),
+                (3, hour // 10), (4, hour % 10),
+                (5, minute // 10), (6, minute % 10),
+                (8, self.length // 100), (9, self.length // 10 % 10),
+                (10, self.length % 10), (15, self.line)):
+            b[:, col] = value + ord("0")
+
+        b[:, 12] = _HEX[self.days >> 4]
+        b[:, 13] = _HEX[self.days & 0xf]
+        return(b.tostring())
+
+    def errors(self, capacity=None):
+        """ Return the indexes of the programs out of range and whether
+        the programs are more than capacity.
+        """
+
+        bad = (self.start < 0) | (self.start >= 1440) | \
+                (self.length < 1) | (self.length > 999) | (self.line > 7)
+        full = capacity is not None and len(self) > capacity
+        return(np.flatnonzero(bad), full)
+
+    def validate(self, capacity=MAX_PROGRAMS):
+        """ Raise ValueError if a program is out of range or they do not
+        fit the device.
+        """
+
+        bad, full = self.errors(capacity)
+
+        if len(bad):
+            raise ValueError("programs out of range: %s" % list(bad))
+
+        if full:
+            raise ValueError("%d programs, the device stores %d" % \
+                    (len(self), capacity))
+
+    def select(self, line=None):
+        """ Return the mask of the programs of a line, all if None. """
+
+        if line is None:
+            return(np.ones(len(self), dtype=bool))
+        else:
+            return(self.line == line)
+
+    def scale(self, factor, line=None):
+        """ Multiply the lengths by factor, at least one minute. """
+
+        s = self.select(line)
+        self.length[s] = np.clip(np.round(self.length[s] * factor), 1, 999)
+
+    def shift(self, minutes, line=None):
+        """ Move the start times by minutes, the programs which cross
+        midnight move to the day before or after.
+        """
+
+        s = self.select(line)
+        day, self.start[s] = np.divmod(self.start[s] + minutes, 1440)
+        self.days[s] = _ROTATE[day % 7, self.days[s]]
+
+if __name__ == "__main__":
+    print "This is a module"
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden schedule module
+
+Tell where the programs of a device overlap: two programs of the same
+line running at the same time, or too many programs at once.
+
+A program runs on the days of its mask from its start for its length,
+if it goes past midnight it goes on in the next day (saturday goes on
+in sunday). Times are minutes from midnight, days are 0 (sunday) to 6.
+
+Example:
+
+s = Schedule(og.programs)
+
+for day, line, a, b in s.conflicts():
+    print "programs", a, "and", b, "overlap on day", day
+
+print s.peak(), s.free_slot(1, 0, 30)
+
+The upcoming irrigations, on the device clock:
+
+for start, end, line in upcoming(og.programs, int(og.time())):
+    print time.asctime(time.gmtime(start)), line
+"""
+
+import bisect
+import heapq
+import itertools
+from program import DAY_NAMES
+
+DAY = 1440
+WEEK = 7 * 86400
+
+class _Intervals:
+    """ The intervals of a (day, line), sorted by start.
+
+    maxend[i] is the latest end of the intervals up to i, so that an
+    overlap is found with a single bisect even if they overlap each
+    other.
+    """
+
+    def __init__(self, intervals):
+        intervals.sort()
+        self.intervals = intervals
+        self.starts = [i[0] for i in intervals]
+        self.maxend = []
+        end = 0
+
+        for i in intervals:
+            end = max(end, i[1])
+            self.maxend.append(end)
+
+    def overlaps(self, start, end):
+        """ Tell if any interval overlaps [start, end). """
+
+        i = bisect.bisect_left(self.starts, end) - 1
+        return(i >= 0 and self.maxend[i] > start)
+
+    def overlapping(self, start, end):
+        """ Return the intervals which overlap [start, end). """
+
+        result = []
+        i = bisect.bisect_left(self.starts, end) - 1
+
+        while i >= 0 and self.maxend[i] > start:
+            if self.intervals[i][1] > start:
+                result.append(self.intervals[i])
+
+            i -= 1
+
+        result.reverse()
+        return(result)
+
+class Schedule:
+    """ An index of the intervals of a list of programs.
+
+    Keyword arguments:
+        programs -- list of program.Program.
+    """
+
+    def __init__(self, programs):
+        self.programs = list(programs)
+        lines = {}
+
+        for n, p in enumerate(self.programs):
+            for day in p.weekdays():
+                for key, start, end in _pieces(day, p.line, p.start,
+                        p.length):
+                    lines.setdefault(key, []).append((start, end, n))
+
+        self._index = dict([(k, _Intervals(v)) for k, v in lines.items()])
+        self._running = {}
+
+        # the number of programs running on a day changes only at
+        # the start and at the end of the intervals.
+        for day in range(7):
+            changes = {}
+
+            for line in range(8):
+                for start, end, n in self._get(day, line).intervals:
+                    changes[start] = changes.get(start, 0) + 1
+                    changes[end] = changes.get(end, 0) - 1
+
+            times = sorted(changes)
+            running = []
+            count = 0
+
+            for t in times:
+                count += changes[t]
+                running.append(count)
+
+            self._running[day] = (times, running)
+
+    def _get(self, day, line):
+        return(self._index.get((day, line)) or _Intervals([]))
+
+    def overlaps(self, day, line, start, length):
+        """ Tell if a program starting on day at start for length
+        minutes would overlap one of the same line.
+        """
+
+        for key, a, b in _pieces(day, line, start, length):
+            if self._get(*key).overlaps(a, b):
+                return(True)
+
+        return(False)
+
+    def overlapping(self, day, line, start, length):
+        """ Return the indexes of the programs of the line which run
+        in [start, start + length) of day.
+        """
+
+        found = set()
+
+        for key, a, b in _pieces(day, line, start, length):
+            for i in self._get(*key).overlapping(a, b):
+                found.add(i[2])
+
+        return(sorted(found))
+
+    def conflicts(self):
+        """ Return (day, line, a, b) for each couple of programs a < b
+        of the same line which overlap on day.
+        """
+
+        result = set()
+
+        for (day, line), index in self._index.items():
+            for start, end, n in index.intervals:
+                for m in [i[2] for i in index.overlapping(start, end)]:
+                    if m > n:
+                        result.add((day, line, n, m))
+
+        return(sorted(result))
+
+    def overlapping_pairs(self):
+        """ Return (days, line, a, b) for each couple of programs a < b
+        of the same line which overlap, with the days they do.
+        """
+
+        pairs = {}
+
+        for day, line, a, b in self.conflicts():
+            pairs.setdefault((line, a, b), []).append(day)
+
+        return(sorted([(tuple(v), k[0], k[1], k[2]) \
+                for k, v in pairs.items()], key=lambda i: i[2:]))
+
+    def conflicts_with(self, program, skip=None):
+        """ Return the (day, index) of the programs program would
+        overlap, the one at index skip (the one it replaces) excluded.
+        """
+
+        result = []
+
+        for day in program.weekdays():
+            for n in self.overlapping(day, program.line, program.start,
+                    program.length):
+                if n != skip:
+                    result.append((day, n))
+
+        return(result)
+
+    def running(self, day, minute):
+        """ Return how many programs are running on day at minute. """
+
+        times, running = self._running[day]
+        i = bisect.bisect_right(times, minute) - 1
+
+        if i < 0:
+            return(0)
+
+        return(running[i])
+
+    def peak(self, day=None, start=0, end=DAY):
+        """ Return the max number of programs running at the same time
+        in [start, end) of day, of the whole week if day is None.
+        """
+
+        if day is None:
+            return(max([self.peak(d) for d in range(7)]))
+
+        times, running = self._running[day]
+        i = bisect.bisect_right(times, start)
+        j = bisect.bisect_left(times, end)
+        return(max([self.running(day, start)] + running[i:j]))
+
+    def free_slot(self, day, line, length, after=0):
+        """ Return the first minute, from after, where a program of
+        length minutes fits on the line of day without overlapping.
+        None if there is none before midnight.
+        """
+
+        start = after
+
+        while start < DAY:
+            ends = []
+
+            # the piece after midnight ends in the next day.
+            for offset, (key, a, b) in enumerate(_pieces(day, line, start,
+                    length)):
+                for i in self._get(*key).overlapping(a, b):
+                    ends.append(i[1] + offset * DAY)
+
+            if not ends:
+                return(start)
+
+            start = max(ends)
+
+        return(None)
+
+def week_start(t):
+    """ Return the time_t of the sunday 00:00 of the week of t.
+
+    The device clock is the local time stored as if it was UTC, so its
+    days are the UTC ones. The epoch was a thursday.
+    """
+
+    days = t // 86400
+    return((days - (days + 4) % 7) * 86400)
+
+def _occurrences(program, now):
+    """ Yield the (start, end, line) of a program not ended at now, in
+    time order, forever.
+    """
+
+    offsets = [(d * DAY + program.start) * 60 for d in program.weekdays()]
+    length = program.length * 60
+
+    if not offsets:
+        return
+
+    # a program of last week may still be running.
+    week = week_start(now) - WEEK
+
+    while True:
+        for offset in offsets:
+            start = week + offset
+
+            if start + length > now:
+                yield((start, start + length, program.line))
+
+        week += WEEK
+
+def upcoming(programs, now, until=None, limit=None):
+    """ Yield the irrigations of the programs which end after now, in
+    time order, as (start, end, line) time_t on the device clock.
+
+    The programs are expanded week by week and merged as needed, the
+    generator never holds more than one event per program.
+
+    Keyword arguments:
+        programs -- list of program.Program.
+        now -- the device clock, from OpenGarden.time().
+        until -- stop at the events starting from this time.
+        limit -- stop after this many events.
+    """
+
+    events = heapq.merge(*[_occurrences(p, int(now)) for p in programs])
+
+    if until is not None:
+        events = itertools.takewhile(lambda e: e[0] < until, events)
+
+    if limit is not None:
+        events = itertools.islice(events, limit)
+
+    return(events)
+
+def _pieces(day, line, start, length):
+    """ Split an interval at midnight into ((day, line), start, end).
+    """
+
+    end = start + length
+
+    if end <= DAY:
+        return([((day, line), start, end)])
+
+    return([((day, line), start, DAY),
+            (((day + 1) % 7, line), 0, end - DAY)])
+
+def describe(days, line, a, b):
+    """ Return a conflict, on a day or on a list of days, as a message.
+    """
+
+    if isinstance(days, int):
+        days = (days,)
+
+    return("programs %02d and %02d of line %d overlap on %s" % (a, b,
+            line, " ".join([DAY_NAMES[d] for d in days])))
+
+if __name__ == "__main__":
+    print "This is a module"
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
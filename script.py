@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden scripts
+
+A script is a list of operations run one after the other on a single
+connection, one per line, empty lines and lines starting with # are
+skipped:
+
+    set-time [<seconds>]        host time if not given.
+    get-time
+    get-version
+    sunsite [0..2]              get, or set if a value is given.
+    valve [monostable|bistable]
+    alarm-level [HIGH|LOW]
+    led [ON|OFF]
+    send-programs <filename>
+    get-programs <filename>     {serial} is replaced by the serial.
+    temperature
+    alarm
+
+The whole script is checked, and the programs read, before talking to
+any device. A device stops at its first failed step.
+
+Example:
+
+steps = parse(open('setup.txt'))
+
+for r in run(og, steps):
+    print r.json()
+"""
+
+import json
+import time
+from program import decodeList, encodeList
+
+# The values each setup operation accepts.
+_SETUP = {
+    "sunsite": (("0", "1", "2"), "rt_load_sunsite", "rt_save_sunsite"),
+    "valve": (("monostable", "bistable"), "rt_load_valve", "rt_save_valve"),
+    "alarm-level": (("HIGH", "LOW"), "rt_load_alarm_level",
+            "rt_save_alarm_level"),
+    "led": (("ON", "OFF"), "rt_load_led_setup", "rt_save_led_setup"),
+}
+
+class Step:
+    """ An operation of a script.
+
+    Attributes:
+        number -- the line of the script.
+        op -- the operation name.
+        args -- its arguments.
+        data -- what the operation needs, parsed in advance.
+    """
+
+    def __init__(self, number, op, args, data=None):
+        self.number = number
+        self.op = op
+        self.args = args
+        self.data = data
+
+class StepResult:
+    """ The outcome of a step on a device.
+
+    Attributes:
+        device -- the device name.
+        step -- the Step.
+        value -- what the step returned.
+        error -- the exception raised, None on success.
+        elapsed -- seconds spent.
+    """
+
+    def __init__(self, device, step):
+        self.device = device
+        self.step = step
+        self.value = None
+        self.error = None
+        self.elapsed = 0.0
+
+    def json(self):
+        """ Return the result as a JSON object on one line. """
+
+        if self.error is None:
+            error = None
+        else:
+            error = str(self.error) or self.error.__class__.__name__
+
+        return(json.dumps({"device": self.device,
+                "line": self.step.number, "op": self.step.op,
+                "args": self.step.args, "result": self.value,
+                "error": error, "elapsed": round(self.elapsed, 3)},
+                sort_keys=True))
+
+def parse(f):
+    """ Read a script.
+
+    Raise ValueError, with the line number, on an unknown operation or
+    a wrong argument.
+
+    Return:
+        the list of Step.
+    """
+
+    steps = []
+
+    for number, line in enumerate(f, 1):
+        fields = line.split()
+
+        if not fields or fields[0].startswith('#'):
+            continue
+
+        op, args = fields[0], fields[1:]
+
+        try:
+            steps.append(Step(number, op, args, _check(op, args)))
+        except (ValueError, IOError) as e:
+            raise ValueError("line %d: %s" % (number, e))
+
+    return(steps)
+
+def _check(op, args):
+    if op in _SETUP:
+        if len(args) > 1 or (args and args[0] not in _SETUP[op][0]):
+            raise ValueError("%s can be only %s" % (op, \
+                    ", ".join(_SETUP[op][0])))
+    elif op == "set-time":
+        if len(args) > 1:
+            raise ValueError("set-time takes the seconds only")
+
+        if args:
+            return(long(args[0]))
+    elif op in ("send-programs", "get-programs"):
+        if len(args) != 1:
+            raise ValueError("%s needs a filename" % op)
+
+        if op == "send-programs":
+            f = open(args[0])
+
+            try:
+                return(decodeList(f))
+            finally:
+                f.close()
+    elif op in ("get-time", "get-version", "temperature", "alarm"):
+        if args:
+            raise ValueError("%s takes no arguments" % op)
+    else:
+        raise ValueError("unknown operation %s" % op)
+
+    return(None)
+
+def execute(og, step):
+    """ Run a step on a connected OpenGarden and return its value. """
+
+    op = step.op
+
+    if op in _SETUP:
+        values, load, save = _SETUP[op]
+
+        if step.args:
+            getattr(og, save)(step.args[0])
+
+        return(getattr(og, load)())
+    elif op == "set-time":
+        if step.data is None:
+            t = long(time.time())
+        else:
+            t = step.data
+
+        og.time(t)
+        return(t)
+    elif op == "get-time":
+        return(og.time())
+    elif op == "get-version":
+        return({"version": og.version, "serial": og.serial})
+    elif op == "temperature":
+        return(og.temperature())
+    elif op == "alarm":
+        return(og.get_alarm())
+    elif op == "send-programs":
+        og.programs = step.data
+        og._save_programs()
+        return(len(step.data))
+    elif op == "get-programs":
+        programs = og._load_programs() or []
+        f = open(step.args[0].replace("{serial}", og.serial), "w")
+
+        try:
+            for i in encodeList(programs):
+                f.write(i)
+                f.write('\n')
+        finally:
+            f.close()
+
+        return(len(programs))
+
+def run(og, steps, device=None):
+    """ Run the steps on a connected OpenGarden, stop at the first
+    which fails.
+
+    Return:
+        a generator of StepResult, one per step run.
+    """
+
+    for step in steps:
+        result = StepResult(device, step)
+        start = time.time()
+
+        try:
+            result.value = execute(og, step)
+        except Exception as e:
+            result.error = e
+
+        result.elapsed = time.time() - start
+        yield result
+
+        if result.error is not None:
+            return
+
+if __name__ == "__main__":
+    print "This is a module"
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" OpenGarden device simulator
+
+Emulate the firmware of an OpenGarden device on the serial protocol,
+to test and benchmark the API without the hardware.
+
+The simulator can be attached to an in memory serial port:
+
+    sim = Simulator()
+    og = OpenGarden()
+    og.connect(LoopbackSerial(sim))
+
+or to a pseudo terminal, which any program can open as a serial port:
+
+    path = sim.attach_pty()
+    og.connect(path)
+
+Run as a script it prints the pty path and serves it until killed:
+
+    ./simulator.py --baudrate 9600 --latency 0.02
+"""
+
+import os
+import time
+import random
+import threading
+import collections
+
+class Simulator:
+    """ The device state and its command interpreter.
+
+    Attributes:
+        baudrate -- if set, the time to transmit each byte is simulated.
+        latency -- seconds the device takes before replying a command.
+        echo_error -- probability of a wrong char in the echo.
+        nook -- probability of refusing a command which replies OK.
+        drop -- probability of ignoring a command, no reply at all.
+        max_programs -- programs the RAM can store, None for no limit.
+        log_prefix -- the start of the log lines.
+        rx_bytes, tx_bytes, commands -- traffic counters.
+        outputs -- functions called with what the device sends on its
+            own, ex. the log lines.
+    """
+
+    def __init__(self, baudrate=None, latency=0, seed=None):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.echo_error = 0
+        self.nook = 0
+        self.drop = 0
+        self.max_programs = None
+        self.log_prefix = "Log: "
+        self.random = random.Random(seed)
+
+        self.version = "0.7"
+        self.serial = "01011409061234"
+        self.sunsite = 0
+        self.valve = 1
+        self.alarm_level = "HIGH"
+        self.led = "ON"
+        self.log = True
+        self.alarm = "OFF"
+        self.temperature = [23.0, 16.46087, 1.29217]
+        self.clock_offset = 0
+        self.programs = []
+        self.eeprom = []
+
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.commands = 0
+        self.outputs = []
+        self._cmd = ''
+        self._lock = threading.Lock()
+        self._log = []
+
+    def byte_time(self):
+        """ Seconds to transmit a byte, 10 bits per byte (8N1).
+        """
+
+        if self.baudrate:
+            return(10.0 / self.baudrate)
+        else:
+            return(0)
+
+    def feed(self, data):
+        """ Receive data from the serial line.
+
+        Return:
+            a list of (delay, output) where delay is the time the
+            device waits before sending output.
+        """
+
+        out = []
+        self.rx_bytes += len(data)
+
+        for c in data:
+            if c == '\r':
+                cmd = self._cmd
+                self._cmd = ''
+
+                if self.random.random() < self.drop:
+                    continue
+
+                # like the firmware, the echo ends with \n\r.
+                out.append((0, '\n\r'))
+                reply = self.command(cmd)
+
+                if reply is not None:
+                    out.append((self.latency, reply))
+
+                with self._lock:
+                    log, self._log = self._log, []
+
+                for line in log:
+                    out.append((0, line))
+            else:
+                self._cmd += c
+
+                if self.random.random() < self.echo_error:
+                    c = chr((ord(c) + 1) % 256)
+
+                out.append((0, c))
+
+        for delay, i in out:
+            self.tx_bytes += len(i)
+
+        return(out)
+
+    def command(self, cmd):
+        """ Execute a command.
+
+        Return:
+            the reply lines or None if the command has no reply.
+        """
+
+        self.commands += 1
+
+        if not cmd:
+            return(None)
+
+        c, arg = cmd[0], cmd[1:]
+
+        try:
+            if arg or c in "Crs":
+                return(self._set(c, arg))
+            else:
+                return(self._get(c) + '\r\n')
+        except (KeyError, ValueError, IndexError):
+            return("ERROR\r\n")
+
+    def _get(self, c):
+        if c == 'v':
+            return("OpenGarden " + self.version)
+        elif c == 'S':
+            return("Serial: " + self.serial)
+        elif c == 'y':
+            return(str(self.sunsite))
+        elif c == 'V':
+            return(str(self.valve))
+        elif c == 'a':
+            return(self.alarm_level)
+        elif c == 'e':
+            return(self.led)
+        elif c == 'l':
+            lines = ["Programs [%02d]" % len(self.programs)]
+
+            for i, p in enumerate(self.programs):
+                lines.append("%02d,%s" % (i, p))
+
+            return('\r\n'.join(lines))
+        elif c == 'd':
+            return(str(self.clock()))
+        elif c == 'g':
+            return("Temperature " + \
+                    ",".join(["%.5f" % i for i in self.temperature]))
+        elif c == 'A':
+            return(self.alarm)
+        else:
+            raise KeyError(c)
+
+    def _set(self, c, arg):
+        if c == 'd':
+            self.clock_offset = int(arg) - int(time.time())
+            return(str(self.clock()) + '\r\n')
+
+        if c == 'p':
+            # the firmware does not answer a program, not even an error.
+            try:
+                self._set_program(arg)
+            except (ValueError, IndexError):
+                pass
+
+            return(None)
+
+        if self.random.random() < self.nook:
+            return("ERROR\r\n")
+
+        if c == 'y' and arg in ('0', '1', '2'):
+            self.sunsite = int(arg)
+        elif c == 'V' and arg in ('1', '2'):
+            self.valve = int(arg)
+        elif c == 'a' and arg in ('H', 'L'):
+            self.alarm_level = {'H': "HIGH", 'L': "LOW"}[arg]
+        elif c == 'e' and arg in ('0', '1'):
+            self.led = {'0': "OFF", '1': "ON"}[arg]
+        elif c == 'L' and arg in ('0', '1'):
+            self.log = arg == '1'
+        elif c == 'C' and not arg:
+            self.programs = []
+        elif c == 'r' and not arg:
+            self.programs = list(self.eeprom)
+        elif c == 's' and not arg:
+            self.eeprom = list(self.programs)
+        else:
+            raise KeyError(c)
+
+        return("OK\r\n")
+
+    def _set_program(self, arg):
+        if self.max_programs is not None and \
+                len(self.programs) >= self.max_programs:
+            raise ValueError(arg)
+
+        self.programs.append(self._check_program(arg))
+
+    def _check_program(self, p):
+        """ Check a program in the HHMM,LLL,MM,L format.
+        """
+
+        start, length, days, line = p.split(',')
+
+        if len(start) != 4 or int(start[:2]) > 23 or int(start[2:]) > 59:
+            raise ValueError(p)
+
+        if len(length) != 3 or int(length) < 1:
+            raise ValueError(p)
+
+        if len(days) != 2:
+            raise ValueError(p)
+
+        int(days, 16)
+
+        if len(line) != 1 or not 0 <= int(line) <= 7:
+            raise ValueError(p)
+
+        return(p)
+
+    def event(self, text):
+        """ Log an event, sent as a log_prefix + text line if the log
+        is on.
+
+        Like the firmware the line is not sent in the middle of a
+        command, it waits for the command to be answered.
+        """
+
+        if not self.log:
+            return
+
+        line = "%s%s\r\n" % (self.log_prefix, text)
+
+        with self._lock:
+            if self._cmd:
+                self._log.append(line)
+                return
+
+        self.tx_bytes += len(line)
+
+        for output in self.outputs:
+            output(line)
+
+    def clock(self):
+        return(int(time.time()) + self.clock_offset)
+
+    def attach_pty(self):
+        """ Serve the simulator on a new pseudo terminal.
+
+        Return:
+            the path of the slave side, to be opened as a serial port.
+        """
+
+        import pty
+        import tty
+
+        master, slave = pty.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        self.outputs.append(lambda data: os.write(master, data))
+        t = threading.Thread(target=self._serve_pty, args=(master,))
+        t.daemon = True
+        t.start()
+
+        # keep the slave open, so the pty survives clients closing it.
+        self._pty_slave = slave
+        return(os.ttyname(slave))
+
+    def _serve_pty(self, fd):
+        while True:
+            try:
+                data = os.read(fd, 256)
+            except OSError:
+                return
+
+            for delay, out in self.feed(data):
+                if delay:
+                    time.sleep(delay)
+
+                if self.baudrate:
+                    time.sleep(len(out) * self.byte_time())
+
+                os.write(fd, out)
+
+class LoopbackSerial:
+    """ In memory serial port connected to a Simulator.
+
+    It implements the part of the pyserial interface used by
+    OpenGarden. With the simulator baudrate set the time on the line
+    is waited for, bytes written are received by the device after
+    their transmission time and the reply comes back at the same pace.
+    A thread can read while another one writes.
+    """
+
+    def __init__(self, simulator, timeout=10):
+        self.sim = simulator
+        self.port = "loopback"
+        self.timeout = timeout
+        self._in = collections.deque()
+        self._busy = 0
+        self._open = True
+        self._cond = threading.Condition()
+        simulator.outputs.append(self._receive)
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def isOpen(self):
+        return(self._open)
+
+    def write(self, data):
+        bt = self.sim.byte_time()
+        now = time.time()
+
+        # the data is on the line until it is all transmitted.
+        if bt:
+            time.sleep(len(data) * bt)
+
+        with self._cond:
+            t = max(now + len(data) * bt, self._busy)
+
+            for delay, out in self.sim.feed(data):
+                t += delay
+
+                for c in out:
+                    t += bt
+                    self._in.append((t, c))
+
+            self._busy = t
+            self._cond.notify_all()
+
+        return(len(data))
+
+    def _receive(self, data):
+        """ Queue what the device sends on its own.
+        """
+
+        bt = self.sim.byte_time()
+
+        with self._cond:
+            t = max(time.time(), self._busy)
+
+            for c in data:
+                t += bt
+                self._in.append((t, c))
+
+            self._busy = t
+            self._cond.notify_all()
+
+    def _ready(self, n, now):
+        """ Return how many bytes (up to n) are received by now and
+        when the next one will be, None if nothing more is coming.
+        """
+
+        ready = 0
+
+        for t, c in self._in:
+            if t > now or ready == n:
+                break
+
+            ready += 1
+
+        if ready < len(self._in):
+            return(ready, self._in[ready][0])
+        else:
+            return(ready, None)
+
+    def _wait(self, n):
+        """ Wait for n bytes to be received or for the timeout.
+        """
+
+        if self.timeout is None:
+            deadline = None
+        else:
+            deadline = time.time() + self.timeout
+
+        while True:
+            now = time.time()
+            ready, wake = self._ready(n, now)
+
+            if ready == n:
+                return(n)
+
+            if deadline is not None:
+                if now >= deadline:
+                    return(ready)
+
+                if wake is None or wake > deadline:
+                    wake = deadline
+
+            if wake is None:
+                self._cond.wait()
+            else:
+                self._cond.wait(max(0, wake - now))
+
+    def read(self, size=1):
+        with self._cond:
+            n = self._wait(size)
+            return(''.join([self._in.popleft()[1] for i in range(n)]))
+
+    def readline(self):
+        line = ''
+
+        while not line.endswith('\n'):
+            c = self.read()
+
+            if not c:
+                break
+
+            line += c
+
+        return(line)
+
+    def inWaiting(self):
+        with self._cond:
+            return(self._ready(None, time.time())[0])
+
+    def flushInput(self):
+        with self._cond:
+            now = time.time()
+
+            while self._in and self._in[0][0] <= now:
+                self._in.popleft()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='OpenGarden simulator.')
+    parser.add_argument('--baudrate', type=int, default=None, \
+            help="simulate the transmission time at this speed.")
+    parser.add_argument('--latency', type=float, default=0, \
+            help="seconds before the device replies a command.")
+    parser.add_argument('--echo-error', type=float, default=0, \
+            metavar="<probability>", help="wrong char in the echo.")
+    parser.add_argument('--nook', type=float, default=0, \
+            metavar="<probability>", help="refuse a command.")
+    parser.add_argument('--drop', type=float, default=0, \
+            metavar="<probability>", help="ignore a command.")
+    parser.add_argument('--events', type=float, default=0, \
+            metavar="<seconds>", help="log a valve event every <seconds>.")
+    parser.add_argument('--log-prefix', default="Log: ", metavar="<text>", \
+            help="start of the log lines.")
+    args = parser.parse_args()
+
+    sim = Simulator(args.baudrate, args.latency)
+    sim.echo_error = args.echo_error
+    sim.nook = args.nook
+    sim.drop = args.drop
+    sim.log_prefix = args.log_prefix
+    print sim.attach_pty()
+
+    try:
+        while True:
+            if args.events:
+                time.sleep(args.events)
+                line = sim.random.randint(0, 7)
+                sim.event("valve %d %s" % (line, \
+                        sim.random.choice(("open", "close"))))
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden telemetry module
+
+Poll the temperature and the alarm's lines of one or many devices on a
+schedule and keep the last samples in memory, so that whoever needs
+them reads the memory instead of the serial line.
+
+Example:
+
+sampler = Sampler(['/dev/ttyUSB0', '/dev/ttyUSB1'], interval=60)
+sampler.start()
+...
+t, now, media, dfactor, alarm = sampler.latest('/dev/ttyUSB0')
+print sampler.minmax('/dev/ttyUSB0', 'now', 3600)
+sampler.stop()
+"""
+
+import time
+import array
+import threading
+from opengarden import OpenGarden
+
+# The values of a sample, after its time.
+FIELDS = ("now", "media", "dfactor", "alarm")
+
+class Ring:
+    """ The last size samples of a device.
+
+    Every field is a fixed size array of doubles written in circle, the
+    memory does not grow with the samples. The alarm is 1.0 when ON
+    and 0.0 when OFF.
+    """
+
+    def __init__(self, size=1440):
+        self.size = size
+        self.count = 0
+        self._next = 0
+        self._lock = threading.Lock()
+        self._time = array.array('d', [0.0] * size)
+        self._fields = [array.array('d', [0.0] * size) for i in FIELDS]
+
+    def __len__(self):
+        return(self.count)
+
+    def append(self, t, values):
+        """ Store a sample, overwriting the oldest one if full.
+
+        Keyword arguments:
+            t -- time of the sample, not older than the last one.
+            values -- the values in the FIELDS order.
+        """
+
+        with self._lock:
+            i = self._next
+            self._time[i] = t
+
+            for column, value in zip(self._fields, values):
+                column[i] = value
+
+            self._next = (i + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def _row(self, i):
+        return(tuple([self._time[i]] + [c[i] for c in self._fields]))
+
+    def _spans(self, since=None):
+        """ Return the (begin, end) array slices of the samples, oldest
+        first, the ones older than since are skipped.
+
+        The samples are in time order, the first one to keep is found
+        with a binary search instead of looking at all of them.
+        """
+
+        start = (self._next - self.count) % self.size
+        low, high = 0, self.count
+
+        if since is not None:
+            while low < high:
+                mid = (low + high) // 2
+
+                if self._time[(start + mid) % self.size] < since:
+                    low = mid + 1
+                else:
+                    high = mid
+
+        begin = (start + low) % self.size
+        end = begin + self.count - low
+
+        if end <= self.size:
+            return([(begin, end)])
+
+        return([(begin, self.size), (0, end - self.size)])
+
+    def latest(self):
+        """ Return the last sample (time, now, media, dfactor, alarm),
+        None if there are none.
+        """
+
+        with self._lock:
+            if not self.count:
+                return(None)
+
+            return(self._row((self._next - 1) % self.size))
+
+    def window(self, seconds=None):
+        """ Return the samples of the last seconds, all of them if None,
+        oldest first.
+        """
+
+        with self._lock:
+            if seconds is None:
+                since = None
+            else:
+                since = time.time() - seconds
+
+            return([self._row(i) for begin, end in self._spans(since) \
+                    for i in xrange(begin, end)])
+
+    def minmax(self, field, seconds=None):
+        """ Return (min, max) of a field in the last seconds, None if
+        there are no samples.
+        """
+
+        column = self._fields[FIELDS.index(field)]
+
+        with self._lock:
+            if seconds is None:
+                since = None
+            else:
+                since = time.time() - seconds
+
+            slices = [column[begin:end] for begin, end in \
+                    self._spans(since) if end > begin]
+
+        if not slices:
+            return(None)
+
+        return((min([min(i) for i in slices]), max([max(i) for i in slices])))
+
+def sample(og):
+    """ Read a sample from a connected OpenGarden.
+
+    Return:
+        the values in the FIELDS order, as floats.
+    """
+
+    now, media, dfactor = [float(i) for i in og.temperature()]
+
+    if og.get_alarm() == "ON":
+        alarm = 1.0
+    else:
+        alarm = 0.0
+
+    return((now, media, dfactor, alarm))
+
+class Sampler:
+    """ Poll the devices every interval seconds.
+
+    Each device has its own thread and connection, which stays open
+    between the samples and is opened again after an error. The last
+    error of a device is in self.errors, None after a good sample.
+
+    Keyword arguments:
+        devices -- serial port names, or OpenGarden objects already
+            connected.
+        interval -- seconds between two samples.
+        size -- samples kept for each device.
+        store -- a tsstore.Store to keep the history of the samples.
+    """
+
+    def __init__(self, devices, interval=60, size=1440, store=None):
+        self.interval = interval
+        self.store = store
+        self.devices = []
+        self.rings = {}
+        self.errors = {}
+        self._running = False
+        self._threads = []
+        self._wakeup = threading.Event()
+
+        for device in devices:
+            if isinstance(device, basestring):
+                name = device
+            else:
+                name = device.serial
+
+            self.devices.append((name, device))
+            self.rings[name] = Ring(size)
+            self.errors[name] = None
+
+    def start(self):
+        """ Start polling in the background. """
+
+        self._running = True
+        self._wakeup.clear()
+
+        for name, device in self.devices:
+            t = threading.Thread(target=self._poll, args=(name, device))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """ Stop polling and close the connections opened. """
+
+        self._running = False
+        self._wakeup.set()
+
+        for t in self._threads:
+            t.join()
+
+        self._threads = []
+
+    def _poll(self, name, device):
+        og = None
+        tick = time.time()
+
+        while self._running:
+            try:
+                if og is None:
+                    if isinstance(device, basestring):
+                        og = OpenGarden()
+                        og.connect(device)
+                    else:
+                        og = device
+
+                t = time.time()
+                values = sample(og)
+                self.rings[name].append(t, values)
+
+                if self.store is not None:
+                    self.store.append(og.serial, t, values)
+
+                self.errors[name] = None
+            except Exception as e:
+                self.errors[name] = e
+                og = self._close(og, device)
+
+            # keep the pace, skip the ticks lost in a slow sample.
+            tick += self.interval
+
+            if tick < time.time():
+                tick = time.time()
+
+            self._wakeup.wait(max(0, tick - time.time()))
+
+        self._close(og, device)
+
+    def _close(self, og, device):
+        if og is not None and og is not device:
+            try:
+                og.disconnect()
+            except Exception:
+                pass
+
+    def latest(self, device):
+        """ Return the last (time, now, media, dfactor, alarm) of a
+        device, None if not sampled yet.
+        """
+
+        return(self.rings[device].latest())
+
+    def window(self, device, seconds=None):
+        """ Return the samples of a device in the last seconds. """
+
+        return(self.rings[device].window(seconds))
+
+    def minmax(self, device, field, seconds=None):
+        """ Return (min, max) of a field of a device in the last seconds.
+        """
+
+        return(self.rings[device].minmax(field, seconds))
+
+if __name__ == "__main__":
+    print "This is a module"
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
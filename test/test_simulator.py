@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests against the simulated device, no hardware needed.
+
+python test/test_simulator.py
+"""
+
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from simulator import Simulator, LoopbackSerial
+from opengarden import OpenGarden, ComError
+from program import decodeList
+from ogarden_daemon import Daemon
+
+# (threaded, blockmode) of the three ways to talk to the device.
+MODES = ((True, True), (False, True), (False, False))
+
+PROGRAMS = ["0600,010,41,3", "0700,010,41,2", "0800,005,7f,1"]
+
+def connect(sim, threaded=True, blockmode=True):
+    og = OpenGarden()
+    og.threaded = threaded
+    og.blockmode = blockmode
+    og.timeout = 2
+    og.connect(LoopbackSerial(sim))
+    return(og)
+
+def temperature(sim):
+    """ Return the temperature of sim as the device prints it. """
+
+    return(["%.5f" % i for i in sim.temperature])
+
+def record(sim):
+    """ Return the list where the commands sim receives are appended.
+    """
+
+    sent = []
+    command = sim.command
+
+    def recorder(cmd):
+        sent.append(cmd)
+        return(command(cmd))
+
+    sim.command = recorder
+    return(sent)
+
+class EchoTest(unittest.TestCase):
+    def test_terminator(self):
+        """ The echo ends with \\n\\r, the reply with \\r\\n. """
+
+        port = LoopbackSerial(Simulator(), timeout=0.2)
+        port.write("v\r")
+        self.assertEqual(port.read(100), "v\n\rOpenGarden 0.7\r\n")
+
+    def test_modes(self):
+        for threaded, blockmode in MODES:
+            sim = Simulator()
+            og = connect(sim, threaded, blockmode)
+
+            try:
+                self.assertEqual(og.version, "0.7")
+                self.assertEqual(og.serial, sim.serial)
+                og.rt_save_sunsite(2)
+                self.assertEqual(og.rt_load_sunsite(), "2")
+                self.assertEqual(og.temperature(), temperature(sim))
+            finally:
+                og.disconnect()
+
+    def test_unsolicited(self):
+        """ A line before the echo is an event, not a wrong echo. """
+
+        sim = Simulator()
+        og = connect(sim)
+        events = og.events(timeout=0.5)
+
+        try:
+            sim.outputs[0]("Log: valve 1 open\r\n")
+            self.assertEqual(og.temperature(), temperature(sim))
+            self.assertEqual([i[1] for i in events], ["Log: valve 1 open"])
+        finally:
+            og.disconnect()
+
+    def test_wrong_echo(self):
+        for threaded, blockmode in MODES:
+            sim = Simulator()
+            og = connect(sim, threaded, blockmode)
+            og.echo_timeout = 0.2
+            sim.echo_error = 1
+
+            try:
+                self.assertRaises(ComError, og.rt_load_valve)
+            finally:
+                og.disconnect()
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = Simulator()
+        self.og = connect(self.sim)
+        self.og.programs = decodeList(PROGRAMS[:2])
+        self.og._save_programs()
+        self.sent = record(self.sim)
+
+    def tearDown(self):
+        self.og.disconnect()
+
+    def test_unchanged(self):
+        self.og._save_programs()
+        self.assertEqual(self.sent, [])
+
+    def test_append(self):
+        self.og.programs = self.og.programs + decodeList(PROGRAMS[2:])
+        self.og._save_programs()
+        self.assertEqual(self.sent, ["p" + PROGRAMS[2]])
+        self.assertEqual(self.sim.programs, PROGRAMS)
+
+    def test_edit(self):
+        """ Only appending is incremental, an edit rewrites them all. """
+
+        self.og.programs = decodeList(PROGRAMS[1:])
+        self.og._save_programs()
+        self.assertEqual(self.sent, ["C"] + ["p" + i for i in PROGRAMS[1:]])
+        self.assertEqual(self.sim.programs, PROGRAMS[1:])
+
+    def test_full(self):
+        self.og._save_programs(full=True)
+        self.assertEqual(self.sent, ["C"] + ["p" + i for i in PROGRAMS[:2]])
+
+    def test_reconnect(self):
+        """ A change not saved does not follow the object to another
+        device.
+        """
+
+        other = Simulator()
+        self.og.sunsite = "2"
+        self.og.connect(LoopbackSerial(other))
+        self.og.save()
+        self.assertEqual(other.sunsite, 0)
+        self.assertEqual(self.og.sunsite, "0")
+
+class BatchTest(unittest.TestCase):
+    def test_program_no_reply(self):
+        """ The firmware does not answer p, the batch must not wait. """
+
+        sim = Simulator()
+        self.assertEqual(sim.command("p" + PROGRAMS[0]), None)
+        self.assertEqual(sim.command("pbad"), None)
+
+    def test_nook(self):
+        """ A NOOK is a whole reply, the next commands get their own. """
+
+        for threaded, blockmode in MODES:
+            sim = Simulator()
+            og = connect(sim, threaded, blockmode)
+
+            try:
+                b = og.batch()
+                b.add("yX")
+                b.add("A", og._read_alarm)
+                b.add("g", og._read_temperature)
+                results = b.run()
+
+                self.assertEqual(results[0][0], "yX")
+                self.assertEqual(results[0][2].args, ('NOOK',))
+                self.assertEqual(results[1], ("A", sim.alarm, None))
+                self.assertEqual(results[2], ("g", temperature(sim), None))
+            finally:
+                og.disconnect()
+
+    def test_recovery(self):
+        """ A reply failing halfway stops the batch, the line is drained
+        and the next commands work.
+        """
+
+        for threaded, blockmode in MODES:
+            sim = Simulator()
+            og = connect(sim, threaded, blockmode)
+
+            try:
+                sim.programs = [PROGRAMS[0], "bad", PROGRAMS[1]]
+                b = og.batch()
+                b.add("l", og._read_programs)
+                b.add("y", og._read_sunsite)
+                b.add("V", og._read_valve)
+                results = b.run()
+
+                self.assertEqual([i[0] for i in results], ["l", "y", "V"])
+
+                for cmd, value, error in results:
+                    self.assertTrue(isinstance(error, ValueError))
+
+                self.assertEqual(og.rt_load_sunsite(), str(sim.sunsite))
+                self.assertEqual(og.temperature(), temperature(sim))
+            finally:
+                og.disconnect()
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = Simulator()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "ogarden.sock")
+        self.daemon = Daemon(self.path, self.sim.attach_pty())
+
+    def tearDown(self):
+        self.daemon.reset()
+        self.daemon.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_socket_mode(self):
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(mode, 0600)
+
+    def test_running(self):
+        """ A second daemon does not take the socket of a running one. """
+
+        try:
+            Daemon(self.path, self.sim.attach_pty())
+        except NameError as e:
+            self.assertEqual(e.args, ('AlreadyRunning',))
+        else:
+            self.fail("the socket was taken over")
+
+    def test_stale(self):
+        """ The socket left by a daemon which is gone is replaced. """
+
+        self.daemon.server_close()
+        self.daemon = Daemon(self.path, self.sim.attach_pty())
+        self.assertEqual(self.daemon.request({"get": "version"}),
+                {"result": "0.7"})
+
+    def test_bad_request(self):
+        og = self.daemon.opengarden()
+        reply = self.daemon.request({"call": "rm -rf"})
+        self.assertEqual(reply, {"error": "BadRequest"})
+        self.assertTrue(self.daemon.og is og)
+
+    def test_reset(self):
+        """ A device error drops the connection, the next request
+        connects again.
+        """
+
+        og = self.daemon.opengarden()
+        og.timeout = 0.5
+        og.echo_timeout = 0.2
+        self.sim.drop = 1
+
+        reply = self.daemon.request({"call": "temperature"})
+        self.assertTrue("error" in reply)
+        self.assertEqual(self.daemon.og, None)
+
+        self.sim.drop = 0
+        reply = self.daemon.request({"call": "temperature"})
+        self.assertEqual(reply, {"result": temperature(self.sim)})
+        self.assertFalse(self.daemon.og is og)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2014 Enrico Rossi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Python-OpenGarden time series store
+
+Keep the history of the temperature and of the alarm of the devices
+on disk, one file per device serial number.
+
+Every file is a header followed by fixed width records, appended in
+time order and never changed:
+
+    time    uint32  time_t of the sample.
+    now     float32 temperature.
+    media   float32 temperature media of the last 24h.
+    dfactor float32
+    alarm   uint8   1 if the alarm's lines are ON, 0 if OFF.
+
+A record written in part, ex. by a crash, is ignored by the queries
+and cut off by the next append.
+
+The files are read through mmap, a query finds its first record with
+a binary search and then walks the records it needs, so years of data
+of a whole fleet are never loaded in memory.
+
+Example:
+
+store = Store('/var/lib/opengarden')
+store.append(og.serial, time.time(), (23.0, 16.4, 1.29, 0))
+
+for t, now, media, dfactor, alarm in store.range(og.serial, start, end):
+    print t, now
+
+for r in store.rollup(og.serial, DAY):
+    print r
+"""
+
+import os
+import mmap
+import struct
+
+MAGIC = "OGTS"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+RECORD = struct.Struct("<Ifff B3x")
+HOUR = 3600
+DAY = 86400
+
+class Store:
+    """ A directory of time series, one file for each device serial.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, serial):
+        return(os.path.join(self.path, serial + ".ogts"))
+
+    def serials(self):
+        """ Return the serials with a time series. """
+
+        return(sorted([i[:-5] for i in os.listdir(self.path) \
+                if i.endswith(".ogts")]))
+
+    def append(self, serial, t, values):
+        """ Append a sample to the time series of a device.
+
+        Keyword arguments:
+            serial -- the device serial number.
+            t -- time of the sample, not older than the last one.
+            values -- (now, media, dfactor, alarm), alarm can be
+                "ON"/"OFF" or a number.
+        """
+
+        now, media, dfactor, alarm = values
+
+        if alarm in ("ON", "OFF"):
+            alarm = alarm == "ON"
+
+        record = RECORD.pack(int(t), float(now), float(media), \
+                float(dfactor), int(bool(alarm)))
+        name = self._file(serial)
+
+        if os.path.exists(name):
+            f = open(name, "r+b")
+        else:
+            f = open(name, "w+b")
+
+        try:
+            size = os.fstat(f.fileno()).st_size
+
+            if size < HEADER.size:
+                size = 0
+            else:
+                # a record cut short (ex. by a crash) is dropped, or
+                # all the records after it would be misaligned.
+                size -= (size - HEADER.size) % RECORD.size
+
+            f.truncate(size)
+            f.seek(size)
+
+            if size == 0:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            else:
+                last = self._last(f, size)
+
+                if last is not None and int(t) < last:
+                    raise NameError('OutOfOrder')
+
+                f.seek(size)
+
+            f.write(record)
+        finally:
+            f.close()
+
+    def _last(self, f, size):
+        """ Return the time of the last record, None if there are none.
+        """
+
+        if size < HEADER.size + RECORD.size:
+            return(None)
+
+        f.seek(size - RECORD.size)
+        return(RECORD.unpack(f.read(RECORD.size))[0])
+
+    def _map(self, serial):
+        """ Map the time series of a device.
+
+        Return:
+            (mmap, number of records), (None, 0) if there is none.
+        """
+
+        name = self._file(serial)
+
+        if not os.path.exists(name):
+            return(None, 0)
+
+        f = open(name, "rb")
+
+        try:
+            size = os.fstat(f.fileno()).st_size
+
+            if size <= HEADER.size:
+                return(None, 0)
+
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic, version, width = HEADER.unpack_from(m, 0)
+
+        if magic != MAGIC or width != RECORD.size:
+            m.close()
+            raise NameError('BadStore')
+
+        return(m, (size - HEADER.size) / RECORD.size)
+
+    def _search(self, m, count, t):
+        """ Return the index of the first record not older than t. """
+
+        lo, hi = 0, count
+
+        while lo < hi:
+            mid = (lo + hi) / 2
+
+            if struct.unpack_from("<I", m, HEADER.size + \
+                    mid * RECORD.size)[0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return(lo)
+
+    def __len__(self):
+        return(sum([self.count(i) for i in self.serials()]))
+
+    def count(self, serial):
+        """ Return the number of records of a device. """
+
+        m, count = self._map(serial)
+
+        if m is not None:
+            m.close()
+
+        return(count)
+
+    def range(self, serial, start=None, end=None):
+        """ Iterate on the records of a device with start <= time < end.
+
+        Return:
+            a generator of (time, now, media, dfactor, alarm).
+        """
+
+        m, count = self._map(serial)
+
+        if m is None:
+            return
+
+        try:
+            if start is None:
+                i = 0
+            else:
+                i = self._search(m, count, start)
+
+            while i < count:
+                record = RECORD.unpack_from(m, HEADER.size + i * RECORD.size)
+
+                if end is not None and record[0] >= end:
+                    break
+
+                yield record
+                i += 1
+        finally:
+            m.close()
+
+    def rollup(self, serial, step=HOUR, start=None, end=None):
+        """ Downsample the records of a device.
+
+        The records are grouped in buckets of step seconds (HOUR, DAY
+        or any other), aligned to the epoch, so UTC days.
+
+        Return:
+            a generator of (bucket time, samples, now min, now max,
+            now mean, media mean, dfactor mean, alarm) for the buckets
+            with samples, where alarm is the fraction of samples with
+            the alarm ON.
+        """
+
+        bucket = None
+
+        for t, now, media, dfactor, alarm in self.range(serial, start, end):
+            b = t - t % step
+
+            if b != bucket:
+                if bucket is not None:
+                    yield _bucket(bucket, acc)
+
+                bucket = b
+                acc = [0, now, now, 0.0, 0.0, 0.0, 0]
+
+            acc[0] += 1
+            acc[1] = min(acc[1], now)
+            acc[2] = max(acc[2], now)
+            acc[3] += now
+            acc[4] += media
+            acc[5] += dfactor
+            acc[6] += alarm
+
+        if bucket is not None:
+            yield _bucket(bucket, acc)
+
+    def fleet_rollup(self, step=DAY, start=None, end=None):
+        """ Return a dictionary serial: list of rollup(), for all the
+        devices in the store.
+        """
+
+        return(dict([(i, list(self.rollup(i, step, start, end))) \
+                for i in self.serials()]))
+
+def _bucket(t, acc):
+    n = acc[0]
+    return((t, n, acc[1], acc[2], acc[3] / n, acc[4] / n, acc[5] / n, \
+            float(acc[6]) / n))
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='OpenGarden history.')
+    parser.add_argument('--store', required=True, metavar="<directory>", \
+            help="the time series directory.")
+    parser.add_argument('--serial', nargs='*', \
+            help="the devices to print, all of them if not given.")
+    parser.add_argument('--rollup', choices=('hour', 'day'), \
+            help="print hourly or daily summaries instead of the samples.")
+    parser.add_argument('--days', type=float, default=1, \
+            help="how many days back to print.")
+    args = parser.parse_args()
+
+    store = Store(args.store)
+    start = time.time() - args.days * DAY
+
+    for serial in args.serial or store.serials():
+        print serial
+
+        if args.rollup:
+            step = {'hour': HOUR, 'day': DAY}[args.rollup]
+
+            for r in store.rollup(serial, step, start):
+                print "  %s %5d %7.2f %7.2f %7.2f %7.2f %7.4f %4.2f" % \
+                        ((time.strftime("%Y-%m-%d %H:%M", \
+                        time.gmtime(r[0])),) + r[1:])
+        else:
+            for r in store.range(serial, start):
+                print "  %s %7.2f %7.2f %7.4f %s" % ((time.strftime( \
+                        "%Y-%m-%d %H:%M:%S", time.localtime(r[0])),) + \
+                        r[1:4] + (("OFF", "ON")[r[4]],))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4